@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Wind Mapper
+# Benchmark of the Windmapper pipeline without WindNinja.
+# Synthetic DEMs of several sizes are run through windmapper.py with the fake WindNinja_cli of this directory.
+# The timings of each stage (DEM preparation, split, jobs, WN runs, post-processing, assembly) are reported and
+# can be compared to a baseline to catch regressions, e.g., in CI:
+#
+#   python bench/run_bench.py --output bench.json
+#   python bench/run_bench.py --baseline bench.json --tolerance 1.5
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal, osr
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+windmapper = os.path.join(bench_dir, '..', 'windmapper.py')
+fake_wn = os.path.join(bench_dir, 'WindNinja_cli')
+
+stages = ['dem_prep', 'split', 'jobs', 'wn_solve', 'postprocess', 'assemble']
+
+
+def make_dem(fic, size, res=30.):
+    # Synthetic DEM of size x size pixels in UTM: a few gaussian hills above a tilted plane
+    rng = np.random.RandomState(size)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    z = 1000. + 300. * x + 200. * y
+    for _ in range(10):
+        x0, y0 = rng.rand(2)
+        width = 0.05 + 0.2 * rng.rand()
+        z += 800. * rng.rand() * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / width ** 2)
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(fic, size, size, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((500000., res, 0., 5600000., 0., -res))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32611)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(z.astype(np.float32))
+    ds = None
+
+
+def run_case(work_dir, size, args, scratch=False):
+    # With scratch, the WN runs use a scratch directory (scratch_dir)
+    name = str(size) + ('_scratch' if scratch else '')
+    fic_dem = os.path.join(work_dir, 'dem_%d.tif' % size)
+    if not os.path.exists(fic_dem):
+        make_dem(fic_dem, size)
+
+    output_dir = os.path.join(work_dir, 'out_' + name)
+    fic_config = os.path.join(work_dir, 'bench_' + name + '.py')
+    with open(fic_config, 'w') as fic_file:
+        fic_file.write(f"""
+res_wind = {args.res_wind}
+ncat = {args.ncat}
+use_existing_dem = True
+dem_filename = {fic_dem!r}
+wind_average = 'grid'
+targ_res = 1000
+wn_exe = {fake_wn!r}
+user_output_dir = {output_dir!r}
+max_tile_cells = {args.max_tile_cells}
+runtime_model_file = {os.path.join(work_dir, 'runtime_model.json')!r}
+""")
+        if scratch:
+            fic_file.write(f"scratch_dir = {os.path.join(work_dir, 'scratch')!r}\n")
+
+    env = dict(os.environ)
+    env['FAKE_WN_DELAY'] = str(args.delay)
+    env['FAKE_WN_DELAY_PER_CELL'] = str(args.delay_per_cell)
+
+    t_start = time.time()
+    subprocess.run([sys.executable, windmapper, fic_config], env=env, check=True,
+                   stdout=subprocess.DEVNULL if not args.verbose else None)
+    total = time.time() - t_start
+
+    # Jobs given up (e.g., outputs not found by the post-processing) leave holes in the library
+    if os.path.exists(os.path.join(output_dir, 'failed_jobs.json')):
+        raise RuntimeError(f'Jobs failed in the run of size {name}, see {output_dir}/failed_jobs.json')
+
+    with open(os.path.join(output_dir, 'timings.json')) as fic_file:
+        timings = json.load(fic_file)
+    timings['total'] = total
+
+    with open(os.path.join(output_dir, 'tiles.json')) as fic_file:
+        timings['ntiles'] = len(json.load(fic_file)['tiles'])
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Windmapper pipeline with a fake WindNinja.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 1000, 3000],
+                        help='sizes of the synthetic DEMs (in pixels of 30 m)')
+    parser.add_argument('--scratch_sizes', type=int, nargs='*', default=[200],
+                        help='sizes of the synthetic DEMs also run with a scratch directory (scratch_dir)')
+    parser.add_argument('--ncat', type=int, default=4, help='number of directions')
+    parser.add_argument('--res_wind', type=int, default=150, help='resolution of the fake WN runs (in m)')
+    parser.add_argument('--max_tile_cells', type=int, default=100 * 100, help='maximum size of the tiles')
+    parser.add_argument('--delay', type=float, default=0., help='delay of each fake WN run (in s)')
+    parser.add_argument('--delay_per_cell', type=float, default=0., help='delay per cell of each fake WN run (in s)')
+    parser.add_argument('--output', help='write the timings to this json file')
+    parser.add_argument('--baseline', help='json file of timings to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='fail if a stage is slower than tolerance x baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the outputs of the runs')
+    parser.add_argument('--verbose', action='store_true', help='show the output of windmapper.py')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='windmapper_bench_')
+    results = {}
+    try:
+        for size in args.sizes:
+            results[str(size)] = run_case(work_dir, size, args)
+        for size in args.scratch_sizes:
+            results[str(size) + '_scratch'] = run_case(work_dir, size, args, scratch=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            print(f'Outputs kept in {work_dir}')
+
+    print('%12s %6s ' % ('size', 'tiles') + ' '.join('%11s' % s for s in stages + ['total']))
+    for size, timings in results.items():
+        print('%12s %6d ' % (size, timings['ntiles']) +
+              ' '.join('%11.2f' % timings.get(s, float('nan')) for s in stages + ['total']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fic_file:
+            json.dump(results, fic_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fic_file:
+            baseline = json.load(fic_file)
+
+        regressions = []
+        for size, timings in results.items():
+            for s in stages + ['total']:
+                ref = baseline.get(size, {}).get(s)
+                # Stages that take less than a tenth of a second are too noisy to compare
+                if ref is not None and s in timings and timings[s] > max(ref, 0.1) * args.tolerance:
+                    regressions.append(f'size {size}, {s}: {timings[s]:.2f} s (baseline {ref:.2f} s)')
+
+        if regressions:
+            print('Regressions:')
+            for r in regressions:
+                print('  ' + r)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# The tests import windmapper and windmapper_query directly. The functions they cover only use numpy and scipy: when
+# GDAL, pyproj or elevation are not installed, they are replaced by stubs so that the modules can still be imported.
+
+import importlib
+import os
+import sys
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+for name in ['osgeo', 'pyproj', 'elevation']:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        sys.modules[name] = mock.MagicMock()
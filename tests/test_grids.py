@@ -0,0 +1,53 @@
+# Tests of the reading of the WN ASCII grids (read_asc) and of the pixel windows of the tiles (projwin_to_window).
+
+import numpy as np
+import pytest
+
+from windmapper import projwin_to_window, read_asc
+
+
+def write_asc(fic, header, values):
+    with open(fic, 'w') as fic_file:
+        for key, value in header:
+            fic_file.write(f'{key} {value}\n')
+        for row in values:
+            fic_file.write(' '.join(str(v) for v in row) + '\n')
+
+
+def test_read_asc_corner(tmp_path):
+    values = np.arange(12, dtype=np.float32).reshape(3, 4) / 4.
+    fic = str(tmp_path / 'vel.asc')
+    write_asc(fic, [('ncols', 4), ('nrows', 3), ('xllcorner', 500000.), ('yllcorner', 5600000.),
+                    ('cellsize', 30.), ('NODATA_value', -9999)], values)
+
+    data, gt = read_asc(fic)
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(data, values)
+    assert gt == (500000., 30., 0., 5600090., 0., -30.)
+
+
+def test_read_asc_center(tmp_path):
+    # Header keys in upper case, origin given at the center of the lower left cell
+    values = np.array([[1.5, -2.], [3.25, 0.]], dtype=np.float32)
+    fic = str(tmp_path / 'ang.asc')
+    write_asc(fic, [('NCOLS', 2), ('NROWS', 2), ('XLLCENTER', 15.), ('YLLCENTER', 25.), ('CELLSIZE', 10.)], values)
+
+    data, gt = read_asc(fic)
+    np.testing.assert_array_equal(data, values)
+    assert gt == pytest.approx((10., 10., 0., 40., 0., -10.))
+
+
+gt = (1000., 30., 0., 2000., 0., -30.)
+
+
+@pytest.mark.parametrize('projwin, window', [
+    # Aligned on the pixels
+    ([1060., 1940., 1360., 1700.], (2, 2, 10, 8)),
+    # Close to the pixel edges, as with the rounding errors of the tile bounds
+    ([1059.99, 1940.01, 1360.01, 1699.99], (2, 2, 10, 8)),
+    # Across the edges of the raster
+    ([940., 2060., 1120., 1880.], (0, 0, 4, 4)),
+    ([2800., 1100., 4400., 600.], (60, 30, 40, 10)),
+])
+def test_projwin_to_window(projwin, window):
+    assert projwin_to_window(gt, (40, 100), projwin) == window
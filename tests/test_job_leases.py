@@ -0,0 +1,97 @@
+# Tests of the leases of the jobs shared by several workers (JobLeases).
+
+import os
+import time
+
+import pytest
+
+from windmapper import JobLeases, cache_job
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two workers of the same manifest. They run in the same process here, so they are told apart by their owner
+    first = JobLeases(str(tmp_path / 'leases'), str(tmp_path / 'cache'), lease_timeout=60.)
+    second = JobLeases(str(tmp_path / 'leases'), str(tmp_path / 'cache'), lease_timeout=60.)
+    second.owner = 'other:1'
+    os.makedirs(str(tmp_path / 'cache'))
+    return first, second
+
+
+def make_stale(leases, job):
+    old = time.time() - 2 * leases.lease_timeout
+    os.utime(leases.path(job), (old, old))
+
+
+def test_claim(workers):
+    first, second = workers
+    job = {'key': 'a'}
+
+    assert first.claim(job)
+    assert first.is_held(job)
+    assert not second.claim(job)
+
+    first.release(job)
+    assert not os.path.exists(first.path(job))
+    assert second.claim(job)
+
+
+def test_claim_done(workers, tmp_path):
+    first, _ = workers
+    job = {'key': 'a'}
+    fic = str(tmp_path / 'out.asc')
+    with open(fic, 'w') as fic_file:
+        fic_file.write('0')
+    cache_job(first.cache_dir, job['key'], {'outputs': [fic]})
+
+    assert not first.claim(job)
+    assert not os.path.exists(first.path(job))
+
+
+def test_claim_stale(workers):
+    # The lease of a dead worker is broken
+    first, second = workers
+    job = {'key': 'a'}
+    assert first.claim(job)
+    make_stale(first, job)
+
+    assert second.claim(job)
+    assert second.owns('a')
+
+
+def test_renew_lost(workers):
+    # A stalled worker finds out that its lease was taken over, and does not remove the lease of the new owner
+    first, second = workers
+    job = {'key': 'a'}
+    other = {'key': 'b'}
+    assert first.claim(job)
+    assert first.claim(other)
+    make_stale(first, job)
+    assert second.claim(job)
+
+    first.last_renew = 0.
+    assert first.renew() == {'a'}
+    assert not first.is_held(job)
+    assert first.is_held(other)
+
+    first.release(job)
+    assert second.owns('a')
+
+    first.release_all()
+    assert not os.path.exists(first.path(other))
+
+
+def test_renew(workers):
+    first, _ = workers
+    job = {'key': 'a'}
+    assert first.claim(job)
+    make_stale(first, job)
+
+    # Not renewed more than once per check_interval
+    first.last_renew = time.time()
+    assert first.renew() == set()
+    assert time.time() - os.path.getmtime(first.path(job)) > first.lease_timeout
+
+    first.last_renew = 0.
+    assert first.renew() == set()
+    assert time.time() - os.path.getmtime(first.path(job)) < first.lease_timeout
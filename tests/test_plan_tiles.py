@@ -0,0 +1,34 @@
+# Tests of the choice of the tiling (plan_tiles).
+
+import pytest
+
+from windmapper import plan_tiles
+
+
+def check_plan(plan, ncols, nrows, pixel, max_tile_cells):
+    assert plan is not None
+    tiles = plan['tiles']
+    assert len(tiles) == plan['nopt_x'] * plan['nopt_y']
+    assert max(tile['wn_cells'] for tile in tiles) <= max_tile_cells
+
+    # The interiors cover the domain without gaps
+    area = sum((t['interior'][1] - t['interior'][0]) * (t['interior'][3] - t['interior'][2]) for t in tiles)
+    assert area == pytest.approx(ncols * nrows * pixel ** 2)
+
+
+@pytest.mark.parametrize('ncols, nrows', [(8000, 8000), (8000, 60), (60, 8000), (200, 200)])
+def test_plan_tiles(ncols, nrows):
+    # Large (240 km at 30 m), narrow and small domains with the default limits
+    max_tile_cells = 600 * 600
+    plan = plan_tiles(500000., 5600000., ncols, nrows, 30., 30., 30, 25, max_tile_cells, 4)
+    check_plan(plan, ncols, nrows, 30., max_tile_cells)
+
+
+def test_plan_tiles_single_tile():
+    plan = plan_tiles(500000., 5600000., 200, 200, 30., 30., 150, 25, 600 * 600, 4)
+    assert plan['nopt_x'] == 1 and plan['nopt_y'] == 1
+
+
+def test_plan_tiles_too_small_limit():
+    # Tiles of overlap only are larger than the limit
+    assert plan_tiles(500000., 5600000., 8000, 8000, 30., 30., 30, 25, 50 * 50, 4) is None
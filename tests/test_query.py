@@ -0,0 +1,64 @@
+# Tests of the point queries of a wind library (WindLibrary.query_chunk).
+
+import numpy as np
+import pytest
+
+from windmapper_query import WindLibrary
+
+
+def make_library(data, gt=(0., 10., 0., 100., 0., -10.)):
+    # Library over an array of shape (rows, cols, directions, variables), with U and V as first variables
+    lib = WindLibrary.__new__(WindLibrary)
+    lib.gt = gt
+    lib.data = data
+    lib.directions = np.arange(0, 360., 360. / data.shape[2])
+    lib.variables = ['U', 'V', 'spd_up_1000'][:data.shape[3]]
+    return lib
+
+
+def wind_vector(wdir):
+    # Unit wind coming from wdir (degrees clockwise from the north)
+    return -np.sin(np.radians(wdir)), -np.cos(np.radians(wdir))
+
+
+def uniform_library(ndirs, speed_up):
+    data = np.empty((10, 10, ndirs, 3), dtype=np.float32)
+    for k, wdir in enumerate(np.arange(0, 360., 360. / ndirs)):
+        data[:, :, k, 0], data[:, :, k, 1] = wind_vector(wdir)
+        data[:, :, k, 2] = speed_up[k]
+    return make_library(data)
+
+
+@pytest.mark.parametrize('wdir', [0., 10., 45., 100., 200., 337.5, 359., 360., 370., -20.])
+def test_rotation(wdir):
+    # Between two directions of the library, the wind vectors are rotated to the direction of the query: a uniform
+    # wind keeps its speed and comes from that direction
+    lib = uniform_library(8, np.arange(8, dtype=np.float32))
+    out = lib.query(np.array([35., 62.]), np.array([45., 71.]), wdir)
+
+    u, v = wind_vector(wdir)
+    np.testing.assert_allclose(out['U'], u, atol=1e-5)
+    np.testing.assert_allclose(out['V'], v, atol=1e-5)
+
+    # The speed up is interpolated linearly between the two nearest directions, across 360 too
+    fd = np.mod(wdir, 360.) / 45.
+    k = int(np.floor(fd))
+    expected = (1. - (fd - k)) * k + (fd - k) * ((k + 1) % 8)
+    np.testing.assert_allclose(out['spd_up_1000'], expected, rtol=1e-5)
+
+
+def test_bilinear():
+    # A linear field is interpolated exactly between the cell centers, and is NaN outside of the library
+    rows, cols = np.mgrid[0:10, 0:10]
+    data = np.zeros((10, 10, 4, 3), dtype=np.float32)
+    data[:, :, :, 2] = (2. * cols + 3. * rows)[:, :, None]
+    lib = make_library(data)
+
+    x = np.array([5., 23., 47.5, 95., 101., -1.])
+    y = np.array([95., 71., 12.5, 5., 50., 50.])
+    out = lib.query(x, y, 0.)
+
+    fx = x / 10. - 0.5
+    fy = (100. - y) / 10. - 0.5
+    np.testing.assert_allclose(out['spd_up_1000'][:4], 2. * fx[:4] + 3. * fy[:4], rtol=1e-5)
+    assert np.all(np.isnan(out['spd_up_1000'][4:]))
@@ -0,0 +1,55 @@
+# Tests of the model of the cost of the WN runs (RuntimeModel).
+
+import numpy as np
+import pytest
+
+from windmapper import RuntimeModel
+
+
+def test_fit():
+    # Coefficients recovered from the timings of jobs of different sizes and roughness
+    model = RuntimeModel()
+    rng = np.random.default_rng(0)
+    for ncells, roughness in zip(rng.integers(10000, 400000, 20), rng.uniform(0., 0.5, 20)):
+        job = {'ncells': int(ncells), 'roughness': float(roughness)}
+        model.observe(job, (2e-4 * ncells + 3e-3 * ncells * roughness) / 4., 4)
+    model.fit()
+
+    assert model.coefs == pytest.approx([2e-4, 3e-3])
+    assert model.predict({'ncells': 1000, 'roughness': 0.1}) == pytest.approx(0.5)
+
+
+def test_fit_few_observations():
+    # With too few timings, the prior is only scaled
+    model = RuntimeModel()
+    prior = list(model.coefs)
+    job = {'ncells': 10000, 'roughness': 0.2}
+    model.observe(job, 3. * model.predict(job), 1)
+    model.fit()
+
+    assert model.coefs == pytest.approx([3. * c for c in prior])
+
+
+def test_sort():
+    model = RuntimeModel()
+    jobs = [{'ncells': 100, 'roughness': 0.1}, {'ncells': 1000}, {'ncells': 100, 'roughness': 0.5}]
+    assert model.sort(jobs) == [jobs[1], jobs[2], jobs[0]]
+
+
+def test_save(tmp_path):
+    fic = str(tmp_path / 'model' / 'runtime_model.json')
+    model = RuntimeModel(fic)
+    for ncells in [1000, 2000, 3000]:
+        model.observe({'ncells': ncells, 'roughness': 0.1}, 1e-3 * ncells, 2)
+    model.fit()
+    model.save()
+
+    loaded = RuntimeModel(fic)
+    assert loaded.observations == model.observations
+    assert loaded.coefs == pytest.approx(model.coefs)
+
+
+def test_invalid_file(tmp_path):
+    fic = tmp_path / 'runtime_model.json'
+    fic.write_text('{')
+    assert RuntimeModel(str(fic)).observations == []
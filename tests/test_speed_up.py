@@ -0,0 +1,88 @@
+# Tests of the speed up computed by blocks of rows (box_mean, mosaic_speed_up) against ndimage.uniform_filter.
+
+import types
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import windmapper
+from windmapper import box_mean, mosaic_speed_up
+
+
+class Band(object):
+    def __init__(self, values):
+        self.values = values
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        return self.values[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+    def WriteArray(self, values, xoff, yoff):
+        self.values[yoff:yoff + values.shape[0], xoff:xoff + values.shape[1]] = values
+
+    def FlushCache(self):
+        pass
+
+
+class Dataset(object):
+    # In-memory stand-in for a single band GDAL dataset
+    def __init__(self, values):
+        self.RasterYSize, self.RasterXSize = values.shape
+        self.band = Band(values)
+
+    def GetRasterBand(self, n):
+        return self.band
+
+    def GetGeoTransform(self):
+        return (0., 1., 0., 0., 0., -1.)
+
+    def GetProjection(self):
+        return ''
+
+    def SetGeoTransform(self, gt):
+        pass
+
+    def SetProjection(self, projection):
+        pass
+
+
+@pytest.fixture
+def fake_gdal(monkeypatch):
+    datasets = {}
+
+    def create(fic, ncols, nrows, nbands, data_type, options=None):
+        datasets[fic] = Dataset(np.full((nrows, ncols), np.nan, dtype=np.float32))
+        return datasets[fic]
+
+    driver = types.SimpleNamespace(Create=create)
+    gdal = types.SimpleNamespace(Open=lambda fic: datasets[fic], GetDriverByName=lambda name: driver,
+                                 GDT_Float32=6)
+    monkeypatch.setattr(windmapper, 'gdal', gdal)
+    return datasets
+
+
+@pytest.mark.parametrize('w', [1, 2, 3, 4, 7])
+def test_box_mean(w):
+    rng = np.random.default_rng(0)
+    var = rng.random((23, 31))
+    lo, hi = w // 2, (w - 1) // 2
+
+    mean = box_mean(np.pad(var, ((lo, hi), (lo, hi)), mode='edge'), w)
+    assert mean.shape == var.shape
+    np.testing.assert_allclose(mean, ndimage.uniform_filter(var, size=w, mode='nearest'), rtol=1e-10)
+
+
+@pytest.mark.parametrize('nsize, block_rows', [(5, 512), (5, 7), (6, 7), (11, 4), (1, 3)])
+def test_mosaic_speed_up(fake_gdal, nsize, block_rows):
+    # Blocks of rows smaller than the window and not dividing the mosaic
+    rng = np.random.default_rng(1)
+    u = rng.normal(5., 2., (45, 38)).astype(np.float32)
+    v = rng.normal(-3., 2., (45, 38)).astype(np.float32)
+    fake_gdal['u'] = Dataset(u)
+    fake_gdal['v'] = Dataset(v)
+
+    mosaic_speed_up('u', 'v', 'out', nsize, block_rows=block_rows)
+
+    vel = np.hypot(u.astype(np.float64), v.astype(np.float64))
+    expected = vel / ndimage.uniform_filter(vel, size=nsize, mode='nearest')
+    np.testing.assert_allclose(fake_gdal['out'].band.values, expected, rtol=1e-5)
@@ -12,13 +12,24 @@
 import elevation
 import pdb, os, shutil
 import subprocess
+import hashlib
+import json
+import tempfile
+import re
+import time
 from osgeo import gdal, ogr, osr
 from pyproj import Proj, transform
 import numpy as np
 import sys
+import types
 import importlib
+import argparse
+import contextlib
+import socket
+import uuid
 from functools import partial
 import itertools
+import heapq
 from scipy import ndimage
 from os import environ
 from concurrent import futures
@@ -29,20 +40,157 @@ gdal.UseExceptions()  # Enable exception support
 
 def main():
     #######  load user configurable paramters here    #######
-    # Check user defined configuration file
+    parser = argparse.ArgumentParser(description='Build a library of wind fields with WindNinja.')
+    parser.add_argument('config', nargs='*',
+                        help='configuration file (i.e. param_existing_DEM.py). With several files, the domains are run '
+                             'as a batch sharing the same cores')
+    parser.add_argument('--plan', action='store_true',
+                        help='prepare the DEM and the tiles, write the job manifest and report the estimated cost of '
+                             'the run (time, memory and disk), without running WindNinja')
+    parser.add_argument('--pilot', action='store_true',
+                        help='with --plan, run the smallest WindNinja job to calibrate the estimated run time')
+    parser.add_argument('--worker', metavar='MANIFEST',
+                        help='run the jobs of a job manifest. Several workers can share the same manifest')
+    parser.add_argument('--assemble', metavar='MANIFEST',
+                        help='build the final library once all the jobs of a job manifest are done')
+    parser.add_argument('--ncores', type=int,
+                        help='number of cores used to run the jobs (default: all the available cores)')
+    args = parser.parse_args()
 
-    if len(sys.argv) == 1:
-        print(
-            'ERROR: wind_mapper.py requires one argument [configuration file] (i.e. wind_mapper.py '
-            'param_existing_DEM.py)')
+    try:
+        run_command(args)
+    except WindMapperError as e:
+        print(e)
         exit(-1)
 
-    # Get name of configuration file/module
-    configfile = sys.argv[-1]
 
-    # Load in configuration file as module
-    X = importlib.machinery.SourceFileLoader('config', configfile)
-    X = X.load_module()
+def run_command(args):
+    # Each run writes a report and a trace of its stages to user_output_dir/telemetry
+    telemetry = Telemetry()
+
+    if args.worker is not None:
+        manifest = load_manifest(args.worker)
+        if args.ncores is not None:
+            manifest['config']['ncores'] = args.ncores
+        with telemetry.record(manifest['config']['user_output_dir'],
+                              'worker_' + socket.gethostname() + '_' + str(os.getpid())):
+            run_jobs(manifest, worker=True, telemetry=telemetry)
+        return
+
+    if args.assemble is not None:
+        manifest = load_manifest(args.assemble)
+        with telemetry.record(manifest['config']['user_output_dir'], 'assemble'):
+            assemble(manifest, telemetry)
+        return
+
+    # Check user defined configuration file
+    if not args.config:
+        raise WindMapperError('ERROR: wind_mapper.py requires one argument [configuration file] (i.e. wind_mapper.py '
+                              'param_existing_DEM.py)')
+
+    if args.plan:
+        for config in args.config:
+            wm = WindMapper(config, args.ncores)
+            # Without resume, prepare starts from an empty output directory: a plan must not delete jobs already run
+            cache_dir = wm.cfg['user_output_dir'] + 'cache'
+            if not wm.cfg['resume'] and os.path.isdir(cache_dir) and \
+                    any(f.endswith('.json') for f in os.listdir(cache_dir)):
+                raise WindMapperError(f'ERROR: {wm.cfg["user_output_dir"]} holds the jobs of a previous run. Set '
+                                      f'resume = True to plan the run on top of them, or choose another '
+                                      f'user_output_dir')
+            with wm.telemetry.record(wm.cfg['user_output_dir'], 'plan'):
+                wm.prepare()
+                if args.pilot:
+                    run_pilot(wm.manifest, wm.telemetry)
+                report = plan_report(wm.manifest)
+            print(f'Job manifest written to {manifest_path(wm.cfg)}')
+            print_plan(report)
+    elif len(args.config) == 1:
+        WindMapper(args.config[0], args.ncores).run()
+    else:
+        run_batch(args.config, args.ncores)
+
+
+class WindMapperError(Exception):
+    # Error in the configuration or the inputs of a run
+    pass
+
+
+class WindMapper(object):
+    # Library API to build the wind library of a domain:
+    #   wm = WindMapper('param_existing_DEM.py')  # or a dict with the options of a configuration file
+    #   outputs = wm.run()                        # paths of the VRTs (or COGs) of the library
+    # The steps can also be run one by one (prepare, run_jobs and assemble). Errors raise WindMapperError.
+
+    def __init__(self, config, ncores=None):
+        self.cfg = load_config(config)
+        if ncores is not None:
+            self.cfg['ncores'] = ncores
+        self.telemetry = Telemetry()
+        self.manifest = None
+        # Directions already assembled while the jobs ran
+        self.finalized = None
+
+    def prepare(self):
+        self.manifest = prepare(self.cfg, self.telemetry)
+        self.finalized = None
+        return self.manifest
+
+    def run_jobs(self):
+        self.finalized = run_jobs(self.manifest, telemetry=self.telemetry)
+
+    def assemble(self):
+        return assemble(self.manifest, self.telemetry, self.finalized)
+
+    def run(self):
+        with self.telemetry.record(self.cfg['user_output_dir'], 'run'):
+            self.prepare()
+            self.run_jobs()
+            return self.assemble()
+
+
+def run_batch(configs, ncores=None):
+    # Build the libraries of several domains. The jobs of all the domains are run by a single scheduler, so that
+    # the jobs of the small domains fill the cores left idle by the large ones.
+    # Returns the paths of the outputs of each domain
+    mappers = [WindMapper(config, ncores) for config in configs]
+
+    output_dirs = [wm.cfg['user_output_dir'] for wm in mappers]
+    if len(set(output_dirs)) < len(output_dirs):
+        raise WindMapperError('ERROR: the domains of a batch must have different user_output_dir')
+
+    with contextlib.ExitStack() as stack:
+        for wm in mappers:
+            stack.enter_context(wm.telemetry.record(wm.cfg['user_output_dir'], 'run'))
+
+        manifests = [wm.prepare() for wm in mappers]
+
+        # The jobs of the batch are recorded once, then reported with the domain they belong to
+        telemetry = Telemetry()
+        try:
+            scheduler = run_domains(manifests, telemetry, finalize=True)
+            for k, wm in enumerate(mappers):
+                wm.finalized = {wdir: r for (domain, wdir), r in scheduler.finalized.items() if domain == k}
+        finally:
+            for k, wm in enumerate(mappers):
+                wm.telemetry.stages += telemetry.stages
+                wm.telemetry.info.update(telemetry.info)
+                wm.telemetry.add_jobs([r for r in telemetry.jobs if r['domain'] == k])
+
+        return [wm.assemble() for wm in mappers]
+
+
+def load_config(config):
+    # Read and check the configuration: a configuration file or a dict with the same options.
+    # Returns the configuration as a dict
+    if isinstance(config, dict):
+        X = types.SimpleNamespace(**config)
+        configfile = None
+    else:
+        # Load in configuration file as module
+        configfile = config
+        X = importlib.machinery.SourceFileLoader('config', configfile)
+        X = X.load_module()
 
     # Resolution of WindNinja simulations (in m)
     res_wind = X.res_wind
@@ -58,11 +206,10 @@ def main():
         wn_exe = X.wn_exe
 
     if not os.path.exists(wn_exe):
-        print('ERROR: Invalid path for WindNinja_cli. Consider specifying a `wn_exe` config option or confirm it is correct.')
-        print(f'Path = {wn_exe}')
-        exit(-1)
+        raise WindMapperError('ERROR: Invalid path for WindNinja_cli. Consider specifying a `wn_exe` config option or '
+                              f'confirm it is correct.\nPath = {wn_exe}')
 
-    environ["WINDNINJA_DATA"] = os.path.join(os.path.dirname(wn_exe), '..', 'share', 'windninja')
+    wn_exe = os.path.abspath(wn_exe)
 
     # Parameter for atmospheric stability in Wind Ninja mass conserving (default value)
     alpha = 1
@@ -73,11 +220,32 @@ def main():
         ncat = X.ncat
 
     if ncat < 1:
-        print('ERROR ncat must be > 0 ')
-        exit(-1)
+        raise WindMapperError('ERROR ncat must be > 0 ')
+
+    # Adaptive directions: WN is first run on adaptive_ncat directions, then on the direction in the middle of each
+    # sector of a tile where the speed up changes by more than adaptive_tol between the two directions bounding the
+    # sector, down to the ncat directions. The directions that are not run are interpolated
+    adaptive_directions = False
+    if hasattr(X, 'adaptive_directions'):
+        adaptive_directions = X.adaptive_directions
+
+    adaptive_ncat = 4
+    if hasattr(X, 'adaptive_ncat'):
+        adaptive_ncat = X.adaptive_ncat
+
+    # Mean absolute change of the speed up between two directions above which the sector is refined
+    adaptive_tol = 0.05
+    if hasattr(X, 'adaptive_tol'):
+        adaptive_tol = X.adaptive_tol
+
+    if adaptive_directions:
+        nrefine = ncat // adaptive_ncat if adaptive_ncat > 0 else 0
+        if adaptive_ncat < 1 or ncat % adaptive_ncat != 0 or nrefine & (nrefine - 1) != 0:
+            raise WindMapperError('ERROR: with adaptive_directions, ncat must be adaptive_ncat times a power of 2')
 
     use_existing_dem = True
 
+    dem_filename = None
     lat_min = -9999
     lon_min = -9999
     lat_max = -9999
@@ -85,7 +253,7 @@ def main():
     if hasattr(X, 'use_existing_dem'):
         use_existing_dem = X.use_existing_dem
     if use_existing_dem:
-        dem_filename = X.dem_filename
+        dem_filename = os.path.abspath(X.dem_filename)
     else:
         lat_min = X.lat_min
         lat_max = X.lat_max
@@ -94,8 +262,27 @@ def main():
 
     if not use_existing_dem:
         if lat_min == -9999 or lon_min == -9999 or lat_max == -9999 or lon_max == -9999:
-            print('Coordinates of the bounding box must be specified to download SRTM DEM.')
-            exit(-1)
+            raise WindMapperError('Coordinates of the bounding box must be specified to download SRTM DEM.')
+
+    # Directory of SRTM tiles (.hgt or .tif) used instead of downloading SRTM, e.g., on nodes without network
+    srtm_dir = None
+    if hasattr(X, 'srtm_dir') and X.srtm_dir is not None:
+        srtm_dir = os.path.abspath(X.srtm_dir)
+        if not os.path.isdir(srtm_dir):
+            raise WindMapperError(f'ERROR: srtm_dir {srtm_dir} is not a directory')
+
+    # Cache of the SRTM DEMs warped to UTM, reused by the next runs inside the same area
+    # None: no cache
+    dem_cache_dir = os.path.join(os.path.expanduser('~'), '.windmapper', 'dem_cache')
+    if hasattr(X, 'dem_cache_dir'):
+        dem_cache_dir = X.dem_cache_dir
+    if dem_cache_dir is not None:
+        dem_cache_dir = os.path.abspath(dem_cache_dir)
+
+    # Maximum size of the DEM cache (in GB). The least recently used DEMs are removed first
+    dem_cache_size = 10
+    if hasattr(X, 'dem_cache_size'):
+        dem_cache_size = X.dem_cache_size
 
     # Method to compute average wind speed used to derive transfert function
     wind_average = 'mean_tile'
@@ -107,38 +294,153 @@ def main():
 
     list_options_average = ['mean_tile', 'grid']
     if wind_average not in list_options_average:
-        print('wind average must be "mean_tile" or "grid"')
-
-        exit(-1)
+        raise WindMapperError('wind average must be "mean_tile" or "grid"')
 
     if targ_res < 0:
-        print('Target resolution must be>0')
-        exit(-1)
+        raise WindMapperError('Target resolution must be>0')
 
-    # output to the specific directory, instead of the root dir of the calling python script
-    user_output_dir = os.getcwd() + '/' + configfile[:-3] + '/'  # use the config filename as output path
+    # The speed up is averaged over targ_res: it cannot be finer than the WN mesh
+    if wind_average == 'grid' and targ_res < res_wind:
+        raise WindMapperError(f'ERROR: targ_res ({targ_res} m) must be >= res_wind ({res_wind} m)')
 
-    if hasattr(X, 'user_output_dir'):
-        user_output_dir = X.user_output_dir
-        if user_output_dir[-1] is not os.path.sep:
-            user_output_dir += os.path.sep
+    # Compute the speed up of 'grid' over the mosaic of all the tiles rather than over each tile
+    mosaic_average = False
+    if hasattr(X, 'mosaic_average'):
+        mosaic_average = X.mosaic_average
 
-    # Delete previous dir (if exists)
-    if os.path.isdir(user_output_dir):
-        shutil.rmtree(user_output_dir, ignore_errors=True)
+    # Number of rows processed at once when computing the speed up over the mosaic
+    mosaic_block_rows = 512
+    if hasattr(X, 'mosaic_block_rows'):
+        mosaic_block_rows = X.mosaic_block_rows
 
-    # make new output dir
-    os.makedirs(user_output_dir)
+    if mosaic_block_rows < 1:
+        raise WindMapperError('mosaic_block_rows must be > 0')
 
-    # Setup file containing WN configuration
-    nworkers = os.cpu_count() or 1
+    # Format of the final library: one vrt per direction and variable pointing to the tiles (default)
+    # or one Cloud-Optimized GeoTIFF per direction and variable
+    output_format = 'vrt'
+    if hasattr(X, 'output_format'):
+        output_format = X.output_format
 
-    # on linux we can ensure that we respect cpu affinity
-    if 'sched_getaffinity' in dir(os):
-        nworkers = len(os.sched_getaffinity(0))
+    if output_format not in ['vrt', 'cog']:
+        raise WindMapperError('output_format must be "vrt" or "cog"')
 
+    # Compression of the COGs
+    output_compress = 'DEFLATE'
+    if hasattr(X, 'output_compress'):
+        output_compress = X.output_compress.upper()
+
+    if output_compress not in ['DEFLATE', 'ZSTD', 'LZW', 'NONE']:
+        raise WindMapperError('output_compress must be "DEFLATE", "ZSTD", "LZW" or "NONE"')
+
+    # Store the COGs as scaled int16 instead of float32
+    output_int16 = False
+    if hasattr(X, 'output_int16'):
+        output_int16 = X.output_int16
+
+    # Also pack the whole library in a single chunked NetCDF4 file, with the direction as a dimension
+    output_store = False
+    if hasattr(X, 'output_store'):
+        output_store = X.output_store
+
+    # output to the specific directory, instead of the root dir of the calling python script
+    if hasattr(X, 'user_output_dir'):
+        user_output_dir = X.user_output_dir
+    elif configfile is not None:
+        user_output_dir = os.getcwd() + '/' + configfile[:-3] + '/'  # use the config filename as output path
+    else:
+        raise WindMapperError('ERROR: user_output_dir must be given with a configuration dict')
+
+    # Absolute path, so that workers started from another directory find the outputs
+    user_output_dir = os.path.abspath(user_output_dir) + os.path.sep
+
+    # Resume a previous run: completed (tile, direction) jobs are kept and skipped
+    resume = False
+    if hasattr(X, 'resume'):
+        resume = X.resume
+
+    # Cores available to the WN jobs. They are shared between concurrent WN runs and the threads of each run
+    # None: all the cores of the machine running the jobs
+    ncores = None
+    if hasattr(X, 'ncores'):
+        ncores = X.ncores
+
+    # Number of threads of each WN run. By default, chosen from the number of jobs and the memory budget
+    wn_threads = None
+    if hasattr(X, 'wn_threads'):
+        wn_threads = X.wn_threads
+
+    # Number of processes that post-process the WN outputs and build the VRTs (or COGs) while WN runs
+    # Their cores are taken out of ncores for the WN runs
+    # None: an eighth of the cores
+    post_workers = None
+    if hasattr(X, 'post_workers'):
+        post_workers = X.post_workers
+
+    # Fast scratch location (local SSD, tmpfs) for the intermediate files of the WN runs
+    # None: the intermediate files are written in user_output_dir
+    scratch_dir = None
+    if hasattr(X, 'scratch_dir'):
+        scratch_dir = X.scratch_dir
+    if scratch_dir is not None:
+        scratch_dir = os.path.abspath(scratch_dir)
+
+    # Disk space available in scratch_dir (in GB). Jobs wait until their intermediate files fit in it
+    # None: no limit
+    scratch_budget = None
+    if hasattr(X, 'scratch_budget'):
+        scratch_budget = X.scratch_budget
+
+    # Memory available to the concurrent WN runs (in GB)
+    # None: 80% of the memory of the machine running the jobs
+    mem_budget = None
+    if hasattr(X, 'mem_budget'):
+        mem_budget = X.mem_budget
+
+    # Estimated memory used by WN per horizontal cell of the mesh (in bytes)
+    wn_mem_per_cell = 4000
+    if hasattr(X, 'wn_mem_per_cell'):
+        wn_mem_per_cell = X.wn_mem_per_cell
+
+    # File where the timings of the WN runs are stored, to predict the runtime of the jobs of the next runs
+    runtime_model_file = os.path.join(os.path.expanduser('~'), '.windmapper', 'runtime_model.json')
+    if hasattr(X, 'runtime_model_file'):
+        runtime_model_file = X.runtime_model_file
+
+    if (ncores is not None and ncores < 1) or (mem_budget is not None and mem_budget <= 0) or \
+            (wn_threads is not None and wn_threads < 1) or (post_workers is not None and post_workers < 1):
+        raise WindMapperError('ERROR: ncores, wn_threads, post_workers and mem_budget must be > 0')
+
+    # Time (in s) after which a job claimed by a worker that stopped renewing its lease can be run by another worker
+    lease_timeout = 600
+    if hasattr(X, 'lease_timeout'):
+        lease_timeout = X.lease_timeout
+
+    # Time limit (in s) of a WN run on a tile of max_tile_cells cells. The limit of each job is scaled by the size of
+    # its tile. None: no limit
+    job_timeout = None
+    if hasattr(X, 'job_timeout'):
+        job_timeout = X.job_timeout
+
+    # Number of times a WN run that failed or timed out is run again before the job is given up
+    job_retries = 2
+    if hasattr(X, 'job_retries'):
+        job_retries = X.job_retries
+
+    # Once all the jobs are started, a run taking more than speculative_factor times its predicted time is started
+    # again on the idle cores and the first run to finish is kept. None: no speculative runs
+    speculative_factor = 2.
+    if hasattr(X, 'speculative_factor'):
+        speculative_factor = X.speculative_factor
+
+    if (job_timeout is not None and job_timeout <= 0) or job_retries < 0 or \
+            (speculative_factor is not None and speculative_factor <= 1):
+        raise WindMapperError('ERROR: job_timeout must be > 0, job_retries >= 0 and speculative_factor > 1')
+
+    # Setup file containing WN configuration
+    # num_threads is set for each job by the scheduler
     # ensure correct formatting on the output
-    fic_config = F"""num_threads = {nworkers}  
+    fic_config = """num_threads = 1  
 initialization_method = domainAverageInitialization 
 units_mesh_resolution = m 
 input_speed = 10.0 
@@ -159,13 +461,126 @@ write_farsite_atm = false """
         fic_config_WN = X.fic_config_WN
 
         if not os.path.exists(fic_config_WN):
-            print('ERROR: Invalid path for cli_massSolver.cfg given in `fic_config_WN` config options.')
-            exit(-1)
+            raise WindMapperError('ERROR: Invalid path for cli_massSolver.cfg given in `fic_config_WN` config options.')
+
+        with open(fic_config_WN) as fic_file:
+            wn_config = fic_file.read()
     else:
-        fic_config_WN = os.path.join(user_output_dir, 'default_cli_massSolver.cfg')
-        with open(fic_config_WN, 'w') as fic_file:
-            fic_file.write(fic_config)
+        wn_config = fic_config
+
+    if wind_average == 'grid':
+        list_tif_2_vrt = ['U', 'V', 'spd_up_' + str(targ_res)]
+    elif wind_average == 'mean_tile':
+        list_tif_2_vrt = ['U', 'V', 'spd_up_tile']
+
+    # Maximum size of a tile for wind ninja (in number of WN cells, overlap included)
+    max_tile_cells = 600 * 600
+    if hasattr(X, 'max_tile_cells'):
+        max_tile_cells = X.max_tile_cells
+
+    # Tiles where the wind is uniform are not run with WN: tiles that are mostly nodata, or flat (water, plains).
+    # They get the input wind in every direction, with a speed up of 1
+    trivial_tiles = False
+    if hasattr(X, 'trivial_tiles'):
+        trivial_tiles = X.trivial_tiles
+
+    # Fraction of nodata above which a tile is trivial
+    trivial_nodata = 0.95
+    if hasattr(X, 'trivial_nodata'):
+        trivial_nodata = X.trivial_nodata
+
+    # A tile is flat if its elevation range (in m) is below trivial_relief and the 99.9th percentile of its slope (m/m)
+    # is below trivial_slope. Both are needed: a tile of plain or sea with a ridge or a cliff on a small part of it is
+    # not flat
+    trivial_relief = 10.
+    if hasattr(X, 'trivial_relief'):
+        trivial_relief = X.trivial_relief
+
+    trivial_slope = 0.05
+    if hasattr(X, 'trivial_slope'):
+        trivial_slope = X.trivial_slope
+
+    # The DEM of each tile is a VRT window over ref-DEM-utm.tif rather than a copy. The GeoTIFF WN needs is only
+    # written when the first job of the tile is about to run, in parallel with the WN runs, and removed once the
+    # jobs of the tile are done
+    virtual_tiles = False
+    if hasattr(X, 'virtual_tiles'):
+        virtual_tiles = X.virtual_tiles
+
+    # Tiles on a global grid anchored at the origin of the coordinate system, rather than a tiling chosen for the
+    # domain, so that a tile is the same in all the domains that contain it and its jobs can be reused when the
+    # domain grows. The tile size is derived from max_tile_cells and res_wind
+    tile_grid = False
+    if hasattr(X, 'tile_grid'):
+        tile_grid = X.tile_grid
+
+    # Output directory of a previous library on the same global grid: the jobs of the tiles it already has are
+    # reused, only the new tiles are run
+    extend_from = None
+    if hasattr(X, 'extend_from'):
+        extend_from = os.path.abspath(X.extend_from) + os.path.sep
+        tile_grid = True
+        if not os.path.exists(extend_from + 'jobs.json'):
+            raise WindMapperError(f'ERROR: no library to extend in {extend_from}')
+        # Extended in place: the library must not be deleted by prepare, its jobs are in the cache of the run
+        if extend_from == user_output_dir:
+            resume = True
+            extend_from = None
+
+    # Additional grid point to ensure correct tile overlap
+    nadd = 25
 
+    return {'res_wind': res_wind,
+            'wn_exe': wn_exe,
+            'ncat': ncat,
+            'adaptive_directions': adaptive_directions,
+            'adaptive_ncat': adaptive_ncat,
+            'adaptive_tol': adaptive_tol,
+            'use_existing_dem': use_existing_dem,
+            'dem_filename': dem_filename,
+            'lat_min': lat_min,
+            'lat_max': lat_max,
+            'lon_min': lon_min,
+            'lon_max': lon_max,
+            'srtm_dir': srtm_dir,
+            'dem_cache_dir': dem_cache_dir,
+            'dem_cache_size': dem_cache_size,
+            'wind_average': wind_average,
+            'targ_res': targ_res,
+            'mosaic_average': mosaic_average and wind_average == 'grid',
+            'mosaic_block_rows': mosaic_block_rows,
+            'list_tif_2_vrt': list_tif_2_vrt,
+            'output_format': output_format,
+            'output_compress': output_compress,
+            'output_int16': output_int16,
+            'output_store': output_store,
+            'user_output_dir': user_output_dir,
+            'resume': resume,
+            'ncores': ncores,
+            'wn_threads': wn_threads,
+            'post_workers': post_workers,
+            'scratch_dir': scratch_dir,
+            'scratch_budget': scratch_budget,
+            'mem_budget': mem_budget,
+            'wn_mem_per_cell': wn_mem_per_cell,
+            'runtime_model_file': runtime_model_file,
+            'lease_timeout': lease_timeout,
+            'job_timeout': job_timeout,
+            'job_retries': job_retries,
+            'speculative_factor': speculative_factor,
+            'wn_config': wn_config,
+            'max_tile_cells': max_tile_cells,
+            'virtual_tiles': virtual_tiles,
+            'tile_grid': tile_grid,
+            'extend_from': extend_from,
+            'trivial_tiles': trivial_tiles,
+            'trivial_nodata': trivial_nodata,
+            'trivial_relief': trivial_relief,
+            'trivial_slope': trivial_slope,
+            'nadd': nadd}
+
+
+def find_gdal_prefix():
     # we need to make sure we pickup the right paths to all the gdal scripts
     gdal_prefix = ''
     try:
@@ -175,83 +590,152 @@ write_farsite_atm = false """
     except:
         raise BaseException(""" ERROR: Could not find gdal-config, please ensure it is installed and on $PATH """)
 
-    # Wind direction increment
-    delta_wind = 360. / ncat
+    return gdal_prefix
 
-    # List of variable to transform from asc into tif
-    var_transform = ['ang', 'vel']
-    if wind_average == 'grid':
-        list_tif_2_vrt = ['U', 'V', 'spd_up_' + str(targ_res)]
-    elif wind_average == 'mean_tile':
-        list_tif_2_vrt = ['U', 'V', 'spd_up_tile']
 
-    # Optimal size for wind ninja
-    nres = 600
+def resolve_resources(cfg):
+    # Cores and memory (in GB) of the machine running the jobs, unless they are set in the configuration
+    ncores = cfg['ncores']
+    if ncores is None:
+        ncores = available_cores()
 
-    # Additional grid point to ensure correct tile overlap
-    nadd = 25
+    mem_budget = cfg['mem_budget']
+    if mem_budget is None:
+        mem_budget = available_memory() * 0.8 / 1024. ** 3
 
-    # Define DEM file to use for WN
-    fic_download = user_output_dir + 'ref-DEM.tif'
+    return ncores, mem_budget
 
-    name_utm = 'ref-DEM-utm'
-    fic_utm = user_output_dir + '/' + name_utm + '.tif'
 
-    if use_existing_dem:
+def manifest_path(cfg):
+    return cfg['user_output_dir'] + 'jobs.json'
+
 
-        # if we are using a user-provided dem, ensure there are no NoData values that border the
-        # DEM which will cause issues
+def load_manifest(fic_manifest):
+    with open(fic_manifest) as fic_file:
+        return json.load(fic_file)
 
-        # mask data values
-        exec_str = """%sgdal_calc.py -A %s --outfile %s --NoDataValue 0 --calc="1*(A>0)" """ % (gdal_prefix,
-            dem_filename, user_output_dir + 'out.tif')
-        subprocess.check_call([exec_str], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
 
-        # convert to shp file
-        exec_str = """%sgdal_polygonize.py -8 -b 1 -f "ESRI Shapefile" %s %s/pols """ % (gdal_prefix,
-            user_output_dir + 'out.tif', user_output_dir)
-        subprocess.check_call([exec_str], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+def prepare(cfg, telemetry=None):
+    # Prepare the DEM, split it into tiles and list the WN jobs
+    # Returns the job manifest, which is also written to user_output_dir/jobs.json
+    if telemetry is None:
+        telemetry = Telemetry()
+    user_output_dir = cfg['user_output_dir']
+    res_wind = cfg['res_wind']
+    nadd = cfg['nadd']
+    gdal_prefix = find_gdal_prefix()
 
-        # clip original with the shpfile
-        exec_str = """%sgdalwarp -of GTiff -cutline %s/pols/out.shp -crop_to_cutline -dstalpha %s %s """ % (gdal_prefix,
-            user_output_dir, dem_filename, fic_utm)
-        subprocess.check_call([exec_str], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    if cfg['resume'] and os.path.isdir(user_output_dir):
+        # Only the WN outputs and the job cache are kept. Everything else is regenerated
+        clean_output_dir(user_output_dir)
+    elif os.path.isdir(user_output_dir):
+        # Delete previous dir (if exists)
+        shutil.rmtree(user_output_dir, ignore_errors=True)
 
-        shutil.rmtree("%s/pols" % user_output_dir)
-        os.remove("%s/out.tif" % user_output_dir)
+    # make new output dir
+    os.makedirs(user_output_dir, exist_ok=True)
 
-    else:
+    # Cache of completed jobs
+    cache_dir = user_output_dir + 'cache' + os.path.sep
+    os.makedirs(cache_dir, exist_ok=True)
 
-        # Properties of the bounding box
-        delta_lat = lat_max - lat_min
-        delta_lon = lon_max - lon_min
+    # WN configuration, num_threads is set for each job by the scheduler
+    with open(os.path.join(user_output_dir, 'default_cli_massSolver.cfg'), 'w') as fic_file:
+        fic_file.write(cfg['wn_config'])
 
-        fac = 0.1  # Expansion factor to make sure that the downloaded SRTM tile is large enough
+    # Tiles are also limited by the memory budget
+    ncores, mem_budget = resolve_resources(cfg)
+    max_tile_cells = min(cfg['max_tile_cells'], int(mem_budget * 1024. ** 3 / cfg['wn_mem_per_cell']))
 
-        lon_mid = (lon_min + lon_max) / 2.
-        lat_mid = (lat_min + lat_max) / 2.
+    # Wind direction increment
+    delta_wind = 360. / cfg['ncat']
 
-        # Download reference SRTM data
-        elevation.clip(bounds=(
-            lon_min - delta_lon * fac, lat_min - delta_lat * fac, lon_max + delta_lon * fac, lat_max + delta_lat * fac),
-            output=fic_download)
+    with telemetry.span('dem_prep') as stage:
+        # Define DEM file to use for WN
+        fic_download = user_output_dir + 'ref-DEM.tif'
 
-        # Get corresponding UTM zone (center of the zone to extract)
-        nepsg_utm = int(32700 - round((45 + lat_mid) / 90, 0) * 100 + round((183 + lon_mid) / 6, 0))
-        srs_out = osr.SpatialReference()
-        srs_out.ImportFromEPSG(nepsg_utm)
+        name_utm = 'ref-DEM-utm'
+        fic_utm = user_output_dir + '/' + name_utm + '.tif'
 
-        # Get bounding box to extract in utm using pyproj
-        WGS84 = Proj(init='EPSG:4326')
-        inp = Proj(init='EPSG:' + str(nepsg_utm))
-        xmin, ymin = transform(WGS84, inp, lon_min, lat_min)
-        xmax, ymax = transform(WGS84, inp, lon_max, lat_max)
+        if cfg['use_existing_dem']:
+            dem_filename = cfg['dem_filename']
 
-        # Extract a rectangular region of interest in utm at 30 m
-        exec_str = '%sgdalwarp %s %s -overwrite -dstnodata -9999 -t_srs "%s" -te %.30f %.30f %.30f %.30f  -tr %.30f ' \
-                   '%.30f -r bilinear '
-        com_string = exec_str % (gdal_prefix, fic_download, fic_utm, srs_out.ExportToProj4(), xmin, ymin, xmax, ymax, 30, 30)
-        subprocess.check_call([com_string], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+            # if we are using a user-provided dem, ensure there are no NoData values that border the
+            # DEM which will cause issues: the DEM is cropped to the window of its valid data (values > 0)
+            window = valid_data_window(dem_filename)
+            if window is None:
+                raise WindMapperError(f'ERROR: {dem_filename} has no valid data (> 0)')
+            translate_tif(dem_filename, fic_utm, gdal_prefix, srcwin=window)
+
+        else:
+
+            lat_min, lat_max, lon_min, lon_max = cfg['lat_min'], cfg['lat_max'], cfg['lon_min'], cfg['lon_max']
+
+            # Properties of the bounding box
+            delta_lat = lat_max - lat_min
+            delta_lon = lon_max - lon_min
+
+            fac = 0.1  # Expansion factor to make sure that the downloaded SRTM tile is large enough
+
+            lon_mid = (lon_min + lon_max) / 2.
+            lat_mid = (lat_min + lat_max) / 2.
+
+            bounds_ll = [lon_min - delta_lon * fac, lat_min - delta_lat * fac,
+                         lon_max + delta_lon * fac, lat_max + delta_lat * fac]
+
+            # Get corresponding UTM zone (center of the zone to extract)
+            nepsg_utm = int(32700 - round((45 + lat_mid) / 90, 0) * 100 + round((183 + lon_mid) / 6, 0))
+            srs_out = osr.SpatialReference()
+            srs_out.ImportFromEPSG(nepsg_utm)
+
+            # Get bounding box to extract in utm using pyproj
+            WGS84 = Proj(init='EPSG:4326')
+            inp = Proj(init='EPSG:' + str(nepsg_utm))
+            xmin, ymin = transform(WGS84, inp, lon_min, lat_min)
+            xmax, ymax = transform(WGS84, inp, lon_max, lat_max)
+
+            # Extract a rectangular region of interest in utm at 30 m
+            # The region is aligned on multiples of the resolution, so that all the DEMs of a UTM zone share the same
+            # grid and a DEM extracted from a larger DEM of the cache is the same as a DEM warped directly
+            res = 30.
+            bounds = [np.floor(xmin / res) * res, np.floor(ymin / res) * res,
+                      np.ceil(xmax / res) * res, np.ceil(ymax / res) * res]
+            source = 'srtm' if cfg['srtm_dir'] is None else 'srtm_dir:' + cfg['srtm_dir']
+
+            dem_cache = None
+            fic_cached = None
+            if cfg['dem_cache_dir'] is not None:
+                dem_cache = DEMCache(cfg['dem_cache_dir'], cfg['dem_cache_size'] * 1024. ** 3)
+                fic_cached = dem_cache.find(source, nepsg_utm, res, bounds)
+
+            if fic_cached is not None:
+                print(f'Using the DEM {fic_cached} of the DEM cache.')
+            else:
+                if cfg['srtm_dir'] is None:
+                    # Download reference SRTM data
+                    elevation.clip(bounds=bounds_ll, output=fic_download)
+                else:
+                    # Mosaic of the local SRTM tiles covering the region
+                    list_srtm = srtm_tiles(cfg['srtm_dir'], bounds_ll)
+                    if not list_srtm:
+                        raise WindMapperError(f'ERROR: no SRTM tile of {cfg["srtm_dir"]} covers the region')
+                    fic_download = user_output_dir + 'ref-DEM.vrt'
+                    build_vrt(fic_download, list_srtm, gdal_prefix)
+
+                if dem_cache is None:
+                    warp_tif(fic_download, fic_utm, srs_out.ExportToProj4(), bounds, res, gdal_prefix)
+                else:
+                    fd, fic_warp = tempfile.mkstemp(dir=cfg['dem_cache_dir'], suffix='.tif')
+                    os.close(fd)
+                    warp_tif(fic_download, fic_warp, srs_out.ExportToProj4(), bounds, res, gdal_prefix)
+                    fic_cached = dem_cache.add(fic_warp, source, nepsg_utm, res, bounds)
+                os.remove(fic_download)
+
+            if fic_cached is not None:
+                translate_tif(fic_cached, fic_utm, gdal_prefix, projwin=[bounds[0], bounds[3], bounds[2], bounds[1]])
+                dem_cache.release(fic_cached)
+
+    timings = {'dem_prep': stage['wall']}
 
     # Get informations on projected file
     ds = gdal.Open(fic_utm)
@@ -266,156 +750,2340 @@ write_farsite_atm = false """
     xmax = xmin + pixel_width * ds.RasterXSize
     ymin = ymax - pixel_height * ds.RasterYSize
 
-    lenx = band.XSize * pixel_width
-    leny = band.YSize * pixel_height
-    len_wn = res_wind * nres
+    # Choose the tiling of the domain
+    if cfg['tile_grid']:
+        # Derived from the configuration only, so that all the domains with the same configuration share the grid
+        tile_size = np.floor((np.sqrt(cfg['max_tile_cells']) * res_wind - 2. * nadd * max(pixel_width, pixel_height)) /
+                             res_wind) * res_wind
+        if tile_size <= 0:
+            raise WindMapperError(f'ERROR: max_tile_cells is too small for tiles with an overlap of {nadd} pixels.')
+        tile_plan = grid_tiles(xmin, ymax, band.XSize, band.YSize, pixel_width, pixel_height, res_wind, nadd,
+                               float(tile_size))
+        if max(tile['wn_cells'] for tile in tile_plan['tiles']) > max_tile_cells:
+            raise WindMapperError(f'ERROR: the tiles of the global grid do not fit in the memory budget of {mem_budget:.1f} GB.')
+    else:
+        tile_plan = plan_tiles(xmin, ymax, band.XSize, band.YSize, pixel_width, pixel_height, res_wind, nadd,
+                               max_tile_cells, cfg['ncat'])
+    if tile_plan is None:
+        raise WindMapperError(f'ERROR: No tiling with an overlap of {nadd} pixels gives tiles of less than {max_tile_cells} WN cells '
+                              f'({max_tile_cells * cfg["wn_mem_per_cell"] / 1024. ** 3:.1f} GB with a memory budget of {mem_budget:.1f} GB).')
+
+    # The rest of the pipeline uses the tile manifest
+    fic_manifest = user_output_dir + 'tiles.json'
+    with open(fic_manifest, 'w') as fic_file:
+        json.dump(tile_plan, fic_file, indent=2)
+
+    with open(fic_manifest) as fic_file:
+        tiles = json.load(fic_file)['tiles']
+
+    print(f'Domain split into {len(tiles)} tiles of at most {max(t["wn_cells"] for t in tiles)} WN cells.')
+
+    with telemetry.span('split') as stage:
+        if cfg['virtual_tiles']:
+            # Windows over the DEM, a GeoTIFF left by a previous run would be stale
+            for tile in tiles:
+                if os.path.exists(user_output_dir + tile['name'] + ".tif"):
+                    os.remove(user_output_dir + tile['name'] + ".tif")
+                clip_tif(fic_utm, tile_dem(cfg, tile), *tile['extent'], gdal_prefix, output_format='VRT')
+        elif len(tiles) == 1:
+            # DEM is small enough for WN
+            fic_tmp = user_output_dir + tiles[0]['name'] + ".tif"
+            shutil.copy(fic_utm, fic_tmp)
+        else:
+            # Split the DEM into smaller DEM for Wind Ninja
+            for tile in tiles:
+                fic_tmp = user_output_dir + tile['name'] + ".tif"
+                with telemetry.span('clip_tif', tile=tile['name']):
+                    clip_tif(fic_utm, fic_tmp, *tile['extent'], gdal_prefix)
+    timings['split'] = stage['wall']
+
+    for tile in tiles:
+        dir_tmp = user_output_dir + 'tmp_dir' + "_" + str(tile['i']) + "_" + str(tile['j'])
+        if not os.path.isdir(dir_tmp):
+            os.makedirs(dir_tmp)
 
-    # Number of Wind Ninja tiles
-    nopt_x = int(lenx // len_wn + 1)
-    nopt_y = int(leny // len_wn + 1)
+    # The hash and the roughness of the tiles are kept in the manifest, for the jobs added by adaptive directions.
+    # Each tile is read once, the tiles in parallel
+    with telemetry.span('tile_stats'):
+        with futures.ProcessPoolExecutor(max_workers=ncores) as executor:
+            fics = [tile_dem(cfg, tile) for tile in tiles]
+            all_stats = executor.map(partial(tile_stats, terrain=cfg['trivial_tiles']), fics,
+                                     chunksize=max(1, len(tiles) // (4 * ncores)))
+            for tile, stats in zip(tiles, all_stats):
+                tile.update(stats)
+
+    # Trivial tiles get analytic wind fields for all the directions instead of WN jobs
+    for tile in tiles:
+        tile['trivial'] = False
+    if cfg['trivial_tiles']:
+        with telemetry.span('trivial_tiles'):
+            for tile in tiles:
+                tile['trivial'] = is_trivial_tile(cfg, tile['terrain'])
+                if tile['trivial']:
+                    for wdir in np.arange(0, 360., delta_wind):
+                        write_trivial_tile(cfg, tile, float(wdir))
+        print(f'{sum(tile["trivial"] for tile in tiles)} trivial tiles get the input wind without WN runs.')
 
-    nx = band.XSize / nopt_x
-    ny = band.YSize / nopt_y
+    # Build WindNinja winds maps
+    # With adaptive directions, only the coarse directions are run first
+    if cfg['adaptive_directions']:
+        delta_wind = 360. / cfg['adaptive_ncat']
+    x_y_wdir = itertools.product([tile for tile in tiles if not tile['trivial']], np.arange(0, 360., delta_wind))
+    x_y_wdir = [p for p in x_y_wdir]
 
-    if nopt_x == 1 and nopt_y == 1:
-        # DEM is small enough for WN
-        name_tmp = 'tmp_0_0'
-        fic_tmp = user_output_dir + name_tmp + ".tif"
-        shutil.copy(fic_utm, fic_tmp)
-    else:
-        # Split the DEM into smaller DEM for Wind Ninja
-        for i in range(0, nopt_x):
-            for j in range(0, nopt_y):
+    # Key each job on the content of its inputs. A job whose key is already in the cache is not run again
+    wn_config_hash = hash_wn_config(cfg['wn_config'])
+
+    jobs = [make_job(cfg, tile, wdir, wn_config_hash) for tile, wdir in x_y_wdir]
+
+    manifest = {'config': cfg,
+                'cache_dir': cache_dir,
+                'tiles': tiles,
+                'jobs': jobs}
+    if cfg['extend_from'] is not None:
+        nreused = reuse_jobs(manifest, jobs)
+        print(f'Reusing {nreused} of {len(jobs)} jobs of the library in {cfg["extend_from"]}.')
+    write_manifest(manifest)
+
+    record_timings(user_output_dir, timings)
+
+    return manifest
+
+
+def make_job(cfg, tile, wdir, wn_config_hash):
+    # WN job for a tile and a direction
+    # With virtual tiles, the GeoTIFF of the tile (dem) is written from its VRT (dem_vrt) before the job runs
+    user_output_dir = cfg['user_output_dir']
+    i, j = tile['i'], tile['j']
+    key = job_key(tile['hash'], wdir, cfg['res_wind'], wn_config_hash, cfg['wind_average'], cfg['targ_res'])
+    job = {'i': i, 'j': j,
+           'wdir': float(wdir),
+           'key': key,
+           'interior': tile['interior'],
+           'dem': user_output_dir + tile['name'] + ".tif",
+           'dir': user_output_dir + 'tmp_dir' + "_" + str(i) + "_" + str(j),
+           'name_base': wn_name_base(user_output_dir, i, j, wdir, cfg['res_wind']),
+           'ncells': tile['wn_cells'],
+           'roughness': tile['roughness']}
+    if cfg['virtual_tiles']:
+        job['dem_vrt'] = tile_dem(cfg, tile)
+    return job
+
+
+def reuse_jobs(manifest, jobs):
+    # Jobs done in the library extend_from are added to the cache, with their outputs linked (or copied) to the
+    # output directory. The tiles of a global grid have the same names, and the same keys if their DEM is the same.
+    # Returns the number of jobs reused
+    cfg = manifest['config']
+    prior_cache = cfg['extend_from'] + 'cache'
+    nreused = 0
+    for job in jobs:
+        if is_job_cached(manifest['cache_dir'], job['key']) or not is_job_cached(prior_cache, job['key']):
+            continue
+
+        with open(os.path.join(prior_cache, job['key'] + '.json')) as fic_file:
+            entry = json.load(fic_file)
+        name_base = wn_name_base(cfg['user_output_dir'], job['i'], job['j'], job['wdir'], cfg['res_wind'])
+        outputs = []
+        for fic, var in zip(entry['outputs'], cfg['list_tif_2_vrt']):
+            fic_out = name_base + var + '.tif'
+            if os.path.exists(fic_out):
+                os.remove(fic_out)
+            try:
+                os.link(fic, fic_out)
+            except OSError:
+                shutil.copy(fic, fic_out)
+            outputs.append(fic_out)
+        cache_job(manifest['cache_dir'], job['key'], dict(entry, outputs=outputs))
+        nreused += 1
+
+    return nreused
+
+
+def tile_dem(cfg, tile):
+    # DEM of a tile: a VRT window over the DEM with virtual tiles, a GeoTIFF otherwise
+    return cfg['user_output_dir'] + tile['name'] + ('.vrt' if cfg['virtual_tiles'] else '.tif')
+
+
+def materialize_dem(fic_vrt, fic_tif, gdal_prefix):
+    # GeoTIFF of a virtual tile for WN. Written to a temporary file first, so that a WN run (of this or another
+    # worker) never reads a partial DEM. Returns the start and end times and the CPU time
+    t_start = time.time()
+    cpu_start = time.process_time()
+    if not os.path.exists(fic_tif):
+        fd, fic_tmp = tempfile.mkstemp(dir=os.path.dirname(fic_tif), suffix='.tif')
+        os.close(fd)
+        translate_tif(fic_vrt, fic_tmp, gdal_prefix)
+        os.replace(fic_tmp, fic_tif)
+    return {'start': t_start, 'end': time.time(), 'cpu': time.process_time() - cpu_start, 'pid': os.getpid()}
+
+
+def write_manifest(manifest):
+    # Written to a temporary file first, so a worker never reads a partial manifest
+    user_output_dir = manifest['config']['user_output_dir']
+    fd, fic_tmp = tempfile.mkstemp(dir=user_output_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fic_file:
+        json.dump(manifest, fic_file)
+    os.replace(fic_tmp, manifest_path(manifest['config']))
+
+
+def run_pilot(manifest, telemetry=None):
+    # Run the smallest job of a manifest, so that the runtime model is calibrated on this machine and this domain
+    # The job is run as a worker, so that no direction is assembled, and its outputs are kept in the cache
+    jobs = [job for job in manifest['jobs'] if not is_job_cached(manifest['cache_dir'], job['key'])]
+    if not jobs:
+        return
+    pilot = dict(manifest, jobs=[min(jobs, key=lambda job: job['ncells'])])
+    print('Running a pilot WindNinja job...')
+    run_jobs(pilot, worker=True, telemetry=telemetry)
+
+
+def plan_report(manifest):
+    # Estimated cost of the jobs of a manifest: number of tiles and jobs, WN wall time on the cores of the machine
+    # (with the runtime model), peak memory of a job and disk used by the intermediate and final files
+    # The report is also written to user_output_dir/plan.json
+    cfg = manifest['config']
+    tiles = manifest['tiles']
+    ncores, mem_budget = resolve_resources(cfg)
+    jobs = [job for job in manifest['jobs'] if not is_job_cached(manifest['cache_dir'], job['key'])]
+    cells = [tile['wn_cells'] for tile in tiles]
+
+    # A job must fit in the memory budget on its own
+    job_memory = max(cells) * cfg['wn_mem_per_cell']
+    if job_memory > mem_budget * 1024. ** 3:
+        raise WindMapperError(f'ERROR: a WN run on the largest tile needs {job_memory / 1024. ** 3:.1f} GB, more than the '
+                              f'memory budget of {mem_budget:.1f} GB')
+
+    # Run time: the jobs are started longest first on the concurrent runs the scheduler would use
+    runtime_model = RuntimeModel(cfg['runtime_model_file'])
+    wall = 0.
+    nconcurrent = 1
+    if jobs:
+        scheduler = WNScheduler([cfg], ncores, mem_budget * 1024. ** 3, cfg['wn_threads'], runtime_model,
+                                npost=cfg['post_workers'])
+        nthreads = scheduler.base_threads(jobs)
+        nconcurrent = max(1, scheduler.ncores // nthreads)
+        slots = [0.] * nconcurrent
+        for job in runtime_model.sort(jobs):
+            heapq.heappush(slots, heapq.heappop(slots) + runtime_model.predict(job) / nthreads)
+        wall = max(slots)
+
+    # Intermediate files: WN outputs of the largest concurrent runs, as estimated by the workspace
+    # Final files: U, V and speed up in float32 for the interior of each tile and direction, and a copy of the library
+    # with COGs (scaled int16 halves it) and the NetCDF store
+    intermediate = sum(sorted(cells, reverse=True)[:nconcurrent]) * Workspace.disk_per_cell
+    interior_cells = sum((t['interior'][1] - t['interior'][0]) * (t['interior'][3] - t['interior'][2])
+                         for t in tiles) / cfg['res_wind'] ** 2
+    tiles_size = interior_cells * 4 * len(cfg['list_tif_2_vrt']) * cfg['ncat']
+    library_size = 0.
+    if cfg['output_format'] == 'cog':
+        library_size += tiles_size / (2. if cfg['output_int16'] else 1.)
+    if cfg['output_store']:
+        library_size += tiles_size / (2. if cfg['output_int16'] else 1.)
+
+    report = {'ntiles': len(tiles),
+              'ntrivial': sum(tile['trivial'] for tile in tiles),
+              'tile_cells': {'min': min(cells), 'median': int(np.median(cells)), 'max': max(cells)},
+              'njobs': len(manifest['jobs']),
+              'njobs_cached': len(manifest['jobs']) - len(jobs),
+              'ncores': ncores,
+              'runtime_observations': len(runtime_model.observations),
+              'wn_wall_time': wall,
+              'wn_core_time': sum(runtime_model.predict(job) for job in jobs),
+              'job_memory': job_memory,
+              'mem_budget': mem_budget * 1024. ** 3,
+              'intermediate_disk': intermediate,
+              'final_disk': tiles_size + library_size}
+    # With adaptive directions, the refinement can add jobs up to ncat directions per tile
+    if cfg['adaptive_directions']:
+        report['njobs_max'] = (len(tiles) - report['ntrivial']) * cfg['ncat']
+
+    with open(cfg['user_output_dir'] + 'plan.json', 'w') as fic_file:
+        json.dump(report, fic_file, indent=2)
+
+    return report
+
+
+def print_plan(report):
+    gb = 1024. ** 3
+    print(f'Tiles: {report["ntiles"]} ({report["ntrivial"]} trivial), WN cells per tile: {report["tile_cells"]["min"]} to '
+          f'{report["tile_cells"]["max"]} (median {report["tile_cells"]["median"]})')
+    print(f'Jobs: {report["njobs"]} ({report["njobs_cached"]} in the cache)' +
+          (f', up to {report["njobs_max"]} with adaptive directions' if 'njobs_max' in report else ''))
+    print(f'Estimated WN time on {report["ncores"]} cores: {report["wn_wall_time"] / 3600.:.2f} h '
+          f'({report["wn_core_time"] / 3600.:.1f} core-hours, from {report["runtime_observations"]} past WN runs)')
+    print(f'Peak memory of a job: {report["job_memory"] / gb:.2f} GB (budget {report["mem_budget"] / gb:.1f} GB)')
+    print(f'Disk: {report["intermediate_disk"] / gb:.2f} GB of intermediate files, {report["final_disk"] / gb:.2f} GB of '
+          f'final files')
+
+
+def run_jobs(manifest, worker=False, telemetry=None):
+    # Run the WN jobs of a manifest that are not in the cache
+    # A worker claims each job before running it, so that several workers can share a manifest
+    # Otherwise, each direction is assembled as soon as all its tiles are done. Returns the outputs of the directions
+    # assembled, by direction
+    if telemetry is None:
+        telemetry = Telemetry()
+    cfg = manifest['config']
+
+    leases = None
+    if worker:
+        leases = JobLeases(cfg['user_output_dir'] + 'leases', manifest['cache_dir'], cfg['lease_timeout'])
+
+    t_start = time.time()
+    scheduler = run_domains([manifest], telemetry, leases, finalize=not worker)
+
+    # Several workers would overwrite each other's timings
+    if not worker:
+        record_timings(cfg['user_output_dir'], {'jobs': time.time() - t_start,
+                                                'wn_solve': sum(scheduler.wn_times),
+                                                'postprocess': sum(r['post']['end'] - r['post']['start']
+                                                                   for r in scheduler.records)})
+
+    return {wdir: r for (domain, wdir), r in scheduler.finalized.items()}
+
+
+def run_domains(manifests, telemetry, leases=None, finalize=False):
+    # Run the WN jobs that are not in the cache of one or several domains with a single scheduler
+    # The cores, the memory and the runtime model are those of the first domain. Returns the scheduler
+    # With finalize, each direction of a domain is assembled as soon as its last job is post-processed
+    # Domains with adaptive directions get new jobs once their jobs are done, until no sector needs refining. Their
+    # directions are only assembled at the end, once the directions that are not run are interpolated. Workers
+    # (with leases) only run the jobs of the manifest
+    adaptive = leases is None and any(m['config']['adaptive_directions'] for m in manifests)
+    finalize = finalize and not adaptive
+
+    jobs = []
+    for k, manifest in enumerate(manifests):
+        todo = [dict(job, domain=k) for job in manifest['jobs'] if not is_job_cached(manifest['cache_dir'], job['key'])]
+        if len(todo) < len(manifest['jobs']):
+            print(f'Skipping {len(manifest["jobs"]) - len(todo)} jobs found in the cache.')
+        jobs += todo
+
+    cfg = manifests[0]['config']
+    ncores, mem_budget = resolve_resources(cfg)
+    runtime_model = RuntimeModel(cfg['runtime_model_file'])
+
+    # The WN runs write their outputs in the scratch workspace, the post-processing writes the final tifs in the
+    # output directories
+    workspace = None
+    if cfg['scratch_dir'] is not None:
+        budget = None
+        if cfg['scratch_budget'] is not None:
+            budget = cfg['scratch_budget'] * 1024. ** 3
+        workspace = Workspace(cfg['scratch_dir'], budget)
+        if leases is None:
+            # Workers share the DEMs of the output directory, a single process reads them from the workspace
+            for k, manifest in enumerate(manifests):
+                for tile in manifest['tiles']:
+                    workspace.hold_dem(manifest['config']['user_output_dir'] + tile['name'] + '.tif', k)
+        jobs = [workspace.place(job) for job in jobs]
+
+    # GDAL tools, for the DEMs of virtual tiles and the directions assembled during the run
+    gdal_prefix = ''
+    if finalize or any(m['config']['virtual_tiles'] for m in manifests):
+        gdal_prefix = find_gdal_prefix()
 
-                xbeg = xmin + i * nx * pixel_width - nadd * pixel_width
-                ybeg = ymin + j * ny * pixel_height - nadd * pixel_height
+    scheduler = WNScheduler([m['config'] for m in manifests], ncores, mem_budget * 1024. ** 3, cfg['wn_threads'],
+                            runtime_model, leases, cfg['post_workers'], workspace, cfg['speculative_factor'],
+                            gdal_prefix)
 
-                delx = nx * pixel_width + 2 * nadd * pixel_width
-                dely = ny * pixel_height + 2 * nadd * pixel_height
+    # Post-processing of the jobs of each domain
+    postprocess = [partial(call_WN_1dir, m['config']['user_output_dir'], m['config']['list_tif_2_vrt'],
+                           m['config']['res_wind'], m['config']['targ_res'], m['config']['wind_average'],
+                           m['cache_dir']) for m in manifests]
 
-                if i == 0.:
-                    xbeg = xmin
-                if i == 0. or i == (nopt_x - 1):
-                    delx = nx * pixel_width + nadd * pixel_width
+    assemble_directions = None
+    if finalize:
+        assemble_directions = [partial(assemble_direction, m['config'], m['tiles'], gdal_prefix) for m in manifests]
 
-                if j == 0.:
-                    ybeg = ymin
-                if j == 0. or j == (nopt_y - 1):
-                    dely = ny * pixel_height + nadd * pixel_height
+    telemetry.info.update({'ncores': ncores, 'mem_budget': mem_budget, 'njobs': len(jobs),
+                           'ncached': sum(len(m['jobs']) for m in manifests) - len(jobs)})
 
-                name_tmp = 'tmp_' + str(i) + "_" + str(j)
-                fic_tmp = user_output_dir + name_tmp + ".tif"
-                clip_tif(fic_utm, fic_tmp, xbeg, xbeg + delx, ybeg, ybeg + dely, gdal_prefix)
+    print(f'Running WindNinja on {len(jobs)} combinations of direction and sub-area. Please be patient...')
+    try:
+        with telemetry.span('jobs'):
+            scheduler.run(jobs, postprocess, assemble_directions)
+
+            while adaptive:
+                jobs = []
+                for k, manifest in enumerate(manifests):
+                    if not manifest['config']['adaptive_directions']:
+                        continue
+                    new_jobs = refine_directions(manifest)
+                    if new_jobs:
+                        if manifest['config']['extend_from'] is not None:
+                            reuse_jobs(manifest, new_jobs)
+                        manifest['jobs'] += new_jobs
+                        write_manifest(manifest)
+                        jobs += [dict(job, domain=k) for job in new_jobs
+                                 if not is_job_cached(manifest['cache_dir'], job['key'])]
+                if not jobs:
+                    break
+                if workspace is not None:
+                    jobs = [workspace.place(job) for job in jobs]
+                print(f'Refining the directions with {len(jobs)} more WindNinja runs...')
+                scheduler.run(jobs, postprocess)
+    finally:
+        # Keep the timings measured, even for a run that did not complete
+        runtime_model.save()
+        telemetry.add_jobs(scheduler.records)
+        # Jobs that failed permanently are marked in the cache, so that the library can be assembled without them
+        for failure in scheduler.failed:
+            record_failure(manifests[failure['domain']]['cache_dir'], failure['key'], failure)
+        telemetry.info['failed'] = len(scheduler.failed)
+        if workspace is not None:
+            workspace.cleanup()
+        for (domain, wdir), r in scheduler.finalized.items():
+            telemetry.stages.append({'name': 'assemble_direction', 'args': {'domain': domain, 'wdir': wdir},
+                                     'start': r['start'], 'end': r['end'], 'wall': r['end'] - r['start'],
+                                     'cpu': r['cpu'], 'pid': 3, 'tid': r['pid']})
+        for r in scheduler.materialized:
+            telemetry.stages.append({'name': 'materialize_dem', 'args': {}, 'start': r['start'], 'end': r['end'],
+                                     'wall': r['end'] - r['start'], 'cpu': r['cpu'], 'pid': 3, 'tid': r['pid']})
+
+    if scheduler.failed:
+        print(f'WARNING: {len(scheduler.failed)} jobs failed after {cfg["job_retries"] + 1} attempts. They are listed in '
+              f'failed_jobs.json once the library is assembled.')
+
+    # The DEMs of the tiles are only needed by the WN runs. Workers share them until all the jobs are done
+    if leases is None and workspace is None:
+        for manifest in manifests:
+            for tile in manifest['tiles']:
+                if os.path.exists(manifest['config']['user_output_dir'] + tile['name'] + '.tif'):
+                    os.remove(manifest['config']['user_output_dir'] + tile['name'] + '.tif')
+
+    return scheduler
+
+
+def assemble(manifest, telemetry=None, finalized=None):
+    # Build the final library from the outputs of the jobs. Returns the paths of the VRTs (or COGs)
+    # The directions of finalized (outputs of assemble_direction by direction) are already built
+    if telemetry is None:
+        telemetry = Telemetry()
+    if finalized is None:
+        finalized = {}
+    cfg = manifest['config']
+    gdal_prefix = find_gdal_prefix()
+
+    # Jobs that failed permanently leave holes in the library, the other jobs must be done
+    missing = [job for job in manifest['jobs'] if not is_job_cached(manifest['cache_dir'], job['key'])]
+    failed = [job for job in missing if is_job_failed(manifest['cache_dir'], job['key'])]
+    if len(failed) < len(missing):
+        raise WindMapperError(f'ERROR: {len(missing) - len(failed)} jobs are not done. Run workers on {manifest_path(cfg)} before assembling.')
+    write_failure_report(manifest, failed)
+
+    if cfg['adaptive_directions']:
+        with telemetry.span('fill_directions'):
+            fill_directions(manifest)
+
+    outputs = []
+    with telemetry.span('assemble') as stage:
+        nwind = np.arange(0, 360., 360. / cfg['ncat'])
+        if any(float(wdir) not in finalized for wdir in nwind):
+            if cfg['output_format'] == 'vrt':
+                print('Building VRTs...')
+            else:
+                print('Building COGs...')
+        # Loop on wind direction to build reference vrt file to be used by mesher
+        with tqdm(total=len(nwind)) as pbar:
+            for wdir in nwind:
+                if float(wdir) in finalized:
+                    outputs += finalized[float(wdir)]['outputs']
+                else:
+                    tiles = manifest['tiles']
+                    if failed:
+                        # Only the tiles with outputs for this direction
+                        tiles = [tile for tile in tiles if os.path.exists(
+                            wn_name_base(cfg['user_output_dir'], tile['i'], tile['j'], wdir, cfg['res_wind']) +
+                            cfg['list_tif_2_vrt'][0] + '.tif')]
+                    if not tiles:
+                        print(f'WARNING: no output for direction {wdir}')
+                    else:
+                        with telemetry.span('assemble_direction', wdir=float(wdir)):
+                            outputs += assemble_direction(cfg, tiles, gdal_prefix, wdir)['outputs']
+                pbar.update(1)
+
+        if cfg['output_store']:
+            print('Building the library store...')
+            with telemetry.span('store'):
+                outputs.append(build_store(cfg))
+
+    record_timings(cfg['user_output_dir'], {'assemble': stage['wall']})
+
+    return outputs
+
+
+def library_file(cfg, wdir, var):
+    # Final output of direction wdir and variable var
+    name = cfg['user_output_dir'] + 'ref-DEM-utm_' + str(int(wdir)) + '_' + var
+    if cfg['output_format'] == 'vrt':
+        return name + '.vrt'
+    return name + '.tif'
+
+
+def build_store(cfg, block_rows=256):
+    # Pack the library in a single NetCDF4 file, ref-DEM-utm_library.nc: one variable per output (U, V, speed up)
+    # with dimensions (direction, y, x). The chunks hold all the directions of a block of block_rows x block_rows
+    # cells, so that a consumer reads all the directions at a location from a single chunk.
+    # The library is copied by blocks of rows, so the memory used does not depend on the size of the domain.
+    try:
+        import netCDF4
+    except ImportError:
+        raise WindMapperError('ERROR: output_store requires the netCDF4 package (pip install netCDF4)')
 
-    # Build WindNinja winds maps
-    x_y_wdir = itertools.product(range(0, nopt_x),
-                                 range(0, nopt_y),
-                                 np.arange(0, 360., delta_wind))
-    x_y_wdir = [p for p in x_y_wdir]
+    nwind = np.arange(0, 360., 360. / cfg['ncat'])
+    fic_store = cfg['user_output_dir'] + 'ref-DEM-utm_library.nc'
 
-    for d in x_y_wdir:
-        i,j,k = d
-        dir_tmp = user_output_dir + 'tmp_dir' + "_" + str(i) + "_" + str(j)
-        if not os.path.isdir(dir_tmp):
-            os.makedirs(dir_tmp)
+    ds = gdal.Open(library_file(cfg, nwind[0], cfg['list_tif_2_vrt'][0]))
+    ncols, nrows = ds.RasterXSize, ds.RasterYSize
+    gt = ds.GetGeoTransform()
+    proj = ds.GetProjection()
+    ds = None
 
-    print(f'Running WindNinja on {len(x_y_wdir)} combinations of direction and sub-area. Please be patient...')
-    with futures.ProcessPoolExecutor(max_workers=nworkers) as executor:
-        res = list(tqdm(executor.map(partial(call_WN_1dir, gdal_prefix, user_output_dir, fic_config_WN,
-                                             list_tif_2_vrt, nopt_x, nopt_y, nx, ny,
-                                             pixel_height, pixel_width, res_wind, targ_res, var_transform, wind_average,
-                                             wn_exe,
-                                             xmin, ymin), x_y_wdir), total=len(x_y_wdir)))
-
-    print('Building VRTs...')
-    # Loop on wind direction to build reference vrt file to be used by mesher
-    nwind = np.arange(0, 360., delta_wind)
-    with tqdm(total=len(nwind)) as pbar:
-        for wdir in nwind:
-            for var in list_tif_2_vrt:
-                name_vrt = user_output_dir + name_utm + '_' + str(int(wdir)) + '_' + var + '.vrt'
-                cmd = "find " + user_output_dir[0:-1] + " -type f -name '*_" + str(int(wdir)) + "_10_" + str(
-                    res_wind) + "m_" + var + "*.tif' -exec " + gdal_prefix+ "gdalbuildvrt " + name_vrt + " {} +"
-                subprocess.check_call([cmd], stdout=subprocess.PIPE,
-                                      shell=True)
-            pbar.update(1)
-
-
-def call_WN_1dir(gdal_prefix, user_output_dir, fic_config_WN, list_tif_2_vrt, nopt_x, nopt_y, nx, ny,
-                 pixel_height, pixel_width, res_wind, targ_res, var_transform, wind_average, wn_exe, xmin, ymin,
-                 ijwdir):
-    i, j, wdir = ijwdir
-
-    # Out directory
-    dir_tmp = user_output_dir + 'tmp_dir' + "_" + str(i) + "_" + str(j)
-    name_tmp = 'tmp_' + str(i) + "_" + str(j)
-    fic_dem_in = user_output_dir + name_tmp + ".tif"
-
-    name_base = dir_tmp + '/' + name_tmp + '_' + str(int(wdir)) + '_10_' + str(res_wind) + 'm_'
-    subprocess.check_call([wn_exe + ' ' +
-                           fic_config_WN + ' --elevation_file ' + fic_dem_in + ' --mesh_resolution ' + str(
-        res_wind) + ' --input_direction ' + str(int(wdir)) + ' --output_path ' + dir_tmp],
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE,
-                          shell=True)
-    for var in var_transform:
-        name_gen = name_base + var
-        subprocess.check_call([gdal_prefix + 'gdal_translate ' + name_gen + '.asc ' + name_gen + '.tif'],
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                              shell=True)
-
-        os.remove(name_gen + '.asc')
-        os.remove(name_gen + '.prj')
-    # Read geotif for angle and velocity to compute speed up
-    gtif = gdal.Open(name_base + 'ang.tif')
-    ang = gtif.GetRasterBand(1).ReadAsArray()
-    vel_tif = gdal.Open(name_base + 'vel.tif')
-    vel = vel_tif.GetRasterBand(1).ReadAsArray()
-    # Compute and save wind components
-    uu = -vel * np.sin(ang * np.pi / 180.)
-    fic_tif = name_base + 'U_large.tif'
-    save_tif(uu, vel_tif, fic_tif)
-    vv = -vel * np.cos(ang * np.pi / 180.)
-    fic_tif = name_base + 'V_large.tif'
-    save_tif(vv, vel_tif, fic_tif)
-    # Compute smooth wind speed
+    nc = netCDF4.Dataset(fic_store + '.tmp', 'w', format='NETCDF4')
+    try:
+        nc.createDimension('direction', len(nwind))
+        nc.createDimension('y', nrows)
+        nc.createDimension('x', ncols)
+
+        direction = nc.createVariable('direction', 'f4', ('direction',))
+        direction[:] = nwind
+        direction.units = 'degree'
+        direction.long_name = 'direction the wind comes from'
+        x = nc.createVariable('x', 'f8', ('x',))
+        x[:] = gt[0] + (np.arange(ncols) + 0.5) * gt[1]
+        x.standard_name = 'projection_x_coordinate'
+        x.units = 'm'
+        y = nc.createVariable('y', 'f8', ('y',))
+        y[:] = gt[3] + (np.arange(nrows) + 0.5) * gt[5]
+        y.standard_name = 'projection_y_coordinate'
+        y.units = 'm'
+
+        # Coordinate system, with the GDAL conventions
+        crs = nc.createVariable('crs', 'i4')
+        crs.spatial_ref = proj
+        crs.GeoTransform = ' '.join(str(v) for v in gt)
+
+        chunks = (len(nwind), min(block_rows, nrows), min(block_rows, ncols))
+        for var in cfg['list_tif_2_vrt']:
+            if cfg['output_int16']:
+                # Packed as int16 with the same precision as the COGs
+                scale = int16_scale[var.split('_')[0]]
+                nc_var = nc.createVariable(var, 'i2', ('direction', 'y', 'x'), zlib=True, shuffle=True,
+                                           chunksizes=chunks, fill_value=-32768)
+                nc_var.scale_factor = scale
+                nc_var.add_offset = 0.
+            else:
+                nc_var = nc.createVariable(var, 'f4', ('direction', 'y', 'x'), zlib=True, shuffle=True,
+                                           chunksizes=chunks, fill_value=np.float32(np.nan))
+            nc_var.grid_mapping = 'crs'
+
+            bands = []
+            for wdir in nwind:
+                ds = gdal.Open(library_file(cfg, wdir, var))
+                if ds.RasterXSize != ncols or ds.RasterYSize != nrows:
+                    raise WindMapperError('ERROR: the outputs of the library do not have the same size')
+                bands.append(ds)
+
+            for row in range(0, nrows, block_rows):
+                nrows_block = min(block_rows, nrows - row)
+                block = np.empty((len(nwind), nrows_block, ncols), dtype=np.float32)
+                for k, ds in enumerate(bands):
+                    band = ds.GetRasterBand(1)
+                    data = band.ReadAsArray(0, row, ncols, nrows_block).astype(np.float32)
+                    nodata = band.GetNoDataValue()
+                    if nodata is not None:
+                        data[data == nodata] = np.nan
+                    # COGs stored as scaled int16
+                    if band.GetScale() not in [None, 1.]:
+                        data *= band.GetScale()
+                    block[k] = data
+                nc_var[:, row:row + nrows_block, :] = np.ma.masked_invalid(block)
+            bands = None
+    finally:
+        nc.close()
+
+    os.replace(fic_store + '.tmp', fic_store)
+    return fic_store
+
+
+def assemble_direction(cfg, tiles, gdal_prefix, wdir):
+    # Build the VRTs (or COGs) of direction wdir from the outputs of its jobs
+    # Returns the paths of the outputs, with the start and end times and the CPU time of the process
+    # The VRTs are built from the outputs of the current tiling only, so stale tiles kept by a resumed run are ignored
+    t_start = time.time()
+    cpu_start = time.process_time()
+    user_output_dir = cfg['user_output_dir']
+    res_wind = cfg['res_wind']
+
+    outputs = []
+    for var in cfg['list_tif_2_vrt']:
+        name_vrt = user_output_dir + 'ref-DEM-utm_' + str(int(wdir)) + '_' + var + '.vrt'
+        list_tif = [wn_name_base(user_output_dir, tile['i'], tile['j'], wdir, res_wind) + var + '.tif'
+                    for tile in tiles]
+
+        fic_mosaic = None
+        if var.startswith('spd_up') and cfg['mosaic_average']:
+            # Speed up from the moving average over the mosaic of the wind speed rather than over each tile
+            list_vrt_uv = []
+            for var_uv in ['U', 'V']:
+                fic_uv = name_vrt[:-4] + '_' + var_uv + '_mosaic.vrt'
+                build_vrt(fic_uv, [wn_name_base(user_output_dir, tile['i'], tile['j'], wdir, res_wind) +
+                                   var_uv + '.tif' for tile in tiles], gdal_prefix)
+                list_vrt_uv.append(fic_uv)
+
+            fic_mosaic = name_vrt[:-4] + '_mosaic.tif'
+            mosaic_speed_up(list_vrt_uv[0], list_vrt_uv[1], fic_mosaic, cfg['targ_res'] / res_wind,
+                            cfg['mosaic_block_rows'])
+            for fic_uv in list_vrt_uv:
+                os.remove(fic_uv)
+            list_tif = [fic_mosaic]
+
+        if cfg['output_format'] == 'vrt':
+            build_vrt(name_vrt, list_tif, gdal_prefix)
+            outputs.append(name_vrt)
+        else:
+            scale = None
+            if cfg['output_int16']:
+                scale = int16_scale[var.split('_')[0]]
+            build_cog(name_vrt[:-4] + '.tif', list_tif, gdal_prefix, cfg['output_compress'], scale)
+            outputs.append(name_vrt[:-4] + '.tif')
+            if fic_mosaic is not None:
+                os.remove(fic_mosaic)
+
+    return {'outputs': outputs, 'start': t_start, 'end': time.time(), 'cpu': time.process_time() - cpu_start,
+            'pid': os.getpid()}
+
+
+def tile_directions(manifest):
+    # Directions run for each tile, sorted. Jobs that failed are left out
+    directions = {tile['name']: [] for tile in manifest['tiles'] if not tile['trivial']}
+    for job in manifest['jobs']:
+        if is_job_cached(manifest['cache_dir'], job['key']):
+            directions['tmp_' + str(job['i']) + '_' + str(job['j'])].append(job['wdir'])
+    return {name: sorted(dirs) for name, dirs in directions.items()}
+
+
+def read_tile_output(cfg, tile, wdir, var):
+    # Final output var of a tile for direction wdir, with its geotransform and projection
+    ds = gdal.Open(wn_name_base(cfg['user_output_dir'], tile['i'], tile['j'], wdir, cfg['res_wind']) + var + '.tif')
+    data = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    gt, proj = ds.GetGeoTransform(), ds.GetProjection()
+    ds = None
+    return data, gt, proj
+
+
+def refine_directions(manifest):
+    # Jobs for the middle direction of each sector of a tile where the mean absolute change of the speed up between
+    # the two directions bounding the sector is larger than adaptive_tol. Sectors are not refined below 360 / ncat
+    # Jobs already in the manifest (e.g., given up in a previous round) or that failed in a previous run are not
+    # proposed again: their sector is left to the interpolation
+    cfg = manifest['config']
+    delta_min = 360. / cfg['ncat']
+    var = cfg['list_tif_2_vrt'][2]
+    wn_config_hash = hash_wn_config(cfg['wn_config'])
+    directions = tile_directions(manifest)
+    keys = set(job['key'] for job in manifest['jobs'])
+
+    new_jobs = []
+    for tile in manifest['tiles']:
+        dirs = directions.get(tile['name'])
+        if not dirs:
+            continue
+        for d_a, d_b in zip(dirs, dirs[1:] + [dirs[0] + 360.]):
+            nsteps = int(round((d_b - d_a) / delta_min))
+            if nsteps < 2:
+                continue
+            spd_a = read_tile_output(cfg, tile, d_a, var)[0]
+            spd_b = read_tile_output(cfg, tile, d_b % 360., var)[0]
+            if np.mean(np.abs(spd_a - spd_b)) > cfg['adaptive_tol']:
+                # On the grid of the ncat directions, so that the direction is the one assembled
+                wdir = ((int(round(d_a / delta_min)) + nsteps // 2) % cfg['ncat']) * delta_min
+                job = make_job(cfg, tile, wdir, wn_config_hash)
+                if job['key'] not in keys and not is_job_failed(manifest['cache_dir'], job['key']):
+                    new_jobs.append(job)
+
+    return new_jobs
+
+
+def fill_directions(manifest):
+    # Outputs of the directions that were not run on a tile, from the two nearest directions run on the tile:
+    # U and V are rotated to the direction and weighted by the angular distance, like the speed up.
+    # The directions run on each tile are written to user_output_dir/directions.json
+    cfg = manifest['config']
+    user_output_dir = cfg['user_output_dir']
+    list_tif_2_vrt = cfg['list_tif_2_vrt']
+    directions = tile_directions(manifest)
+
+    for tile in manifest['tiles']:
+        dirs = directions.get(tile['name'])
+        if not dirs:
+            continue
+        for wdir in np.arange(0, 360., 360. / cfg['ncat']):
+            wdir = float(wdir)
+            if wdir in dirs:
+                continue
+
+            # Directions bounding wdir
+            k = np.searchsorted(dirs, wdir)
+            d_a = dirs[k - 1] if k > 0 else dirs[-1] - 360.
+            d_b = dirs[k] if k < len(dirs) else dirs[0] + 360.
+            w_b = (wdir - d_a) / (d_b - d_a)
+
+            uu = np.zeros(0)
+            vv = np.zeros(0)
+            spd = np.zeros(0)
+            for d, w in [(d_a, 1. - w_b), (d_b, w_b)]:
+                u, gt, proj = read_tile_output(cfg, tile, d % 360., list_tif_2_vrt[0])
+                v = read_tile_output(cfg, tile, d % 360., list_tif_2_vrt[1])[0]
+                s = read_tile_output(cfg, tile, d % 360., list_tif_2_vrt[2])[0]
+                # The wind vectors of direction d turned by wdir - d
+                rot = np.radians(wdir - d)
+                u_rot = np.cos(rot) * u + np.sin(rot) * v
+                v_rot = -np.sin(rot) * u + np.cos(rot) * v
+                uu = uu + w * u_rot
+                vv = vv + w * v_rot
+                spd = spd + w * s
+
+            name_base = wn_name_base(user_output_dir, tile['i'], tile['j'], wdir, cfg['res_wind'])
+            for var, data in zip(list_tif_2_vrt, [uu, vv, spd]):
+                save_tif(data.astype(np.float32), gt, proj, name_base + var + '.tif')
+
+    with open(user_output_dir + 'directions.json', 'w') as fic_file:
+        json.dump(directions, fic_file, indent=2)
+
+
+def record_timings(user_output_dir, timings):
+    # Add the wall time (in s) of stages of the run to user_output_dir/timings.json
+    fic = user_output_dir + 'timings.json'
+    all_timings = {}
+    if os.path.exists(fic):
+        with open(fic) as fic_file:
+            all_timings = json.load(fic_file)
+    all_timings.update(timings)
+
+    fd, fic_tmp = tempfile.mkstemp(dir=user_output_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fic_file:
+        json.dump(all_timings, fic_file, indent=2)
+    os.replace(fic_tmp, fic)
+
+
+def mosaic_speed_up(fic_u, fic_v, fic_out, nsize, block_rows=512):
+    # Local speed up vel / <vel> over a whole mosaic, with <vel> the moving average of the wind speed over a window of
+    # nsize cells (same window and edge handling as ndimage.uniform_filter with mode='nearest').
+    # The mosaic is processed by blocks of rows, with running sums, so the memory used is bounded by the size of a
+    # block and not by the size of the mosaic.
+    w = max(1, int(nsize))
+    lo, hi = w // 2, (w - 1) // 2
+
+    ds_u = gdal.Open(fic_u)
+    ds_v = gdal.Open(fic_v)
+    ncols, nrows = ds_u.RasterXSize, ds_u.RasterYSize
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(fic_out, ncols, nrows, 1, gdal.GDT_Float32,
+                           options=['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'])
+    out_ds.SetGeoTransform(ds_u.GetGeoTransform())
+    out_ds.SetProjection(ds_u.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(nrows, r0 + block_rows)
+
+        # Rows of the block and of the window around it
+        a0 = max(0, r0 - lo)
+        a1 = min(nrows, r1 + hi)
+        uu = ds_u.GetRasterBand(1).ReadAsArray(0, a0, ncols, a1 - a0).astype(np.float32)
+        vv = ds_v.GetRasterBand(1).ReadAsArray(0, a0, ncols, a1 - a0).astype(np.float32)
+        vel = np.hypot(uu, vv, out=uu)
+        del vv
+
+        # Beyond the edges of the mosaic, the nearest value is used
+        vel = np.pad(vel, ((lo - (r0 - a0), hi - (a1 - r1)), (lo, hi)), mode='edge')
+
+        mean = box_mean(vel, w)
+        speed_up = vel[lo:lo + r1 - r0, lo:lo + ncols] / mean
+        out_band.WriteArray(speed_up.astype(np.float32), 0, r0)
+
+    out_band.FlushCache()
+    out_ds = None
+    ds_u = None
+    ds_v = None
+
+
+def box_mean(var, w):
+    # Mean over all the w x w windows of var, from the running sums along each axis
+    # The output has w - 1 fewer rows and columns than var
+    csum = np.cumsum(var, axis=1, dtype=np.float64)
+    csum = np.concatenate([np.zeros((csum.shape[0], 1)), csum], axis=1)
+    sums = csum[:, w:] - csum[:, :-w]
+
+    csum = np.cumsum(sums, axis=0)
+    csum = np.concatenate([np.zeros((1, csum.shape[1])), csum], axis=0)
+    sums = csum[w:] - csum[:-w]
+
+    return sums / (w * w)
+
+
+class Telemetry(object):
+    # Spans of the stages of a run and records of the WN jobs, written at the end of the run to
+    # user_output_dir/telemetry/ as a json run report and a Chrome trace-event file (chrome://tracing or
+    # https://ui.perfetto.dev). In the timeline, the stages are shown in the windmapper process, each concurrent WN
+    # run in a lane of the WindNinja process and the post-processing in one lane per worker process. The number of
+    # busy cores is shown as a counter, so the gaps where cores sit idle stand out.
+
+    # A WN run is an outlier if its wall time per cell is more than outlier_factor times the median
+    outlier_factor = 3.
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.stages = []
+        self.jobs = []
+        self.info = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # Wall and CPU time (of this process) of a stage. The record of the stage is filled on exit
+        stage = {'name': name, 'args': args, 'start': time.time()}
+        cpu = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage['end'] = time.time()
+            stage['wall'] = stage['end'] - stage['start']
+            stage['cpu'] = time.process_time() - cpu
+            self.stages.append(stage)
+
+    @contextlib.contextmanager
+    def record(self, user_output_dir, name):
+        # Span over a whole run, written to user_output_dir/telemetry/ even if the run fails
+        try:
+            with self.span(name):
+                yield self
+        finally:
+            self.write(user_output_dir, name)
+
+    def add_jobs(self, records):
+        self.jobs.extend(records)
+
+    def summary(self):
+        summary = {'wall': time.time() - self.t0, 'stages': {}}
+        for stage in self.stages:
+            total = summary['stages'].setdefault(stage['name'], {'count': 0, 'wall': 0., 'cpu': 0.})
+            total['count'] += 1
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+
+        if not self.jobs:
+            return summary
+
+        wn_wall = np.array([r['wn_end'] - r['wn_start'] for r in self.jobs])
+        wn_cpu = np.array([r['wn_cpu'] for r in self.jobs])
+        queue_wait = np.array([r['queue_wait'] for r in self.jobs])
+        per_cell = wn_wall / np.array([r['ncells'] for r in self.jobs])
+        limit = self.outlier_factor * np.median(per_cell)
+
+        summary['jobs'] = {'count': len(self.jobs),
+                           'wn_wall': float(wn_wall.sum()),
+                           'wn_cpu': float(wn_cpu.sum()),
+                           'wn_max_rss': max(r['wn_max_rss'] for r in self.jobs),
+                           'queue_wait_mean': float(queue_wait.mean()),
+                           'queue_wait_max': float(queue_wait.max()),
+                           'post_wall': sum(r['post']['end'] - r['post']['start'] for r in self.jobs),
+                           'outliers': [r['name'] for r, t in zip(self.jobs, per_cell) if t > limit]}
+
+        # Share of the cores used by the WN runs while the jobs were running
+        t_start = min(r['wn_start'] for r in self.jobs)
+        t_end = max(r['post']['end'] for r in self.jobs)
+        if 'ncores' in self.info and t_end > t_start:
+            summary['jobs']['core_utilization'] = float(wn_cpu.sum()) / (self.info['ncores'] * (t_end - t_start))
+
+        return summary
+
+    def trace_events(self):
+        def us(t):
+            return int((t - self.t0) * 1e6)
+
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+                  for pid, name in [(1, 'windmapper'), (2, 'WindNinja'), (3, 'post-processing')]]
+
+        for stage in self.stages:
+            events.append({'name': stage['name'], 'ph': 'X', 'pid': stage.get('pid', 1), 'tid': stage.get('tid', 0),
+                           'ts': us(stage['start']),
+                           'dur': us(stage['end']) - us(stage['start']), 'args': dict(stage['args'], cpu=stage['cpu'])})
+
+        busy = []
+        for r in self.jobs:
+            args = {k: r[k] for k in ['threads', 'ncells', 'queue_wait', 'wn_cpu', 'wn_max_rss', 'wn_bytes_read',
+                                      'wn_bytes_written']}
+            events.append({'name': r['name'], 'ph': 'X', 'pid': 2, 'tid': r['lane'], 'ts': us(r['wn_start']),
+                           'dur': us(r['wn_end']) - us(r['wn_start']), 'args': args})
+            post = r['post']
+            events.append({'name': r['name'], 'ph': 'X', 'pid': 3, 'tid': post['pid'], 'ts': us(post['start']),
+                           'dur': us(post['end']) - us(post['start']),
+                           'args': {k: post[k] for k in ['cpu', 'bytes_read', 'bytes_written']}})
+            busy += [(r['wn_start'], r['threads']), (r['wn_end'], -r['threads'])]
+
+        ncores = 0
+        for t, n in sorted(busy):
+            ncores += n
+            events.append({'name': 'busy cores', 'ph': 'C', 'pid': 2, 'ts': us(t), 'args': {'cores': ncores}})
+
+        return events
+
+    def write(self, user_output_dir, name):
+        # Writes <name>_report.json and <name>_trace.json
+        out_dir = user_output_dir + 'telemetry' + os.path.sep
+        os.makedirs(out_dir, exist_ok=True)
+
+        report = {'name': name,
+                  'host': socket.gethostname(),
+                  'pid': os.getpid(),
+                  'start': self.t0,
+                  'info': self.info,
+                  'summary': self.summary(),
+                  'stages': self.stages,
+                  'jobs': self.jobs}
+
+        for suffix, content in [('_report.json', report), ('_trace.json', {'traceEvents': self.trace_events()})]:
+            fd, fic_tmp = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fic_file:
+                json.dump(content, fic_file, indent=1)
+            os.replace(fic_tmp, out_dir + name + suffix)
+
+
+class WNScheduler(object):
+    # Run the WN jobs as direct child processes of the main process.
+    # The cores are split between the concurrent WN runs and the threads of each run so that the machine is never
+    # oversubscribed, and a run is only started if its estimated memory fits in the remaining memory budget.
+    # Once a WN run is complete, its post-processing is done in a small pool of worker processes, whose cores are
+    # reserved out of ncores.
+
+    # Jobs are started longest first, as predicted by the runtime model, so that the end of the run is not
+    # stalled by a few long jobs while most cores are idle.
+    # With leases, a job is only run if it can be claimed, so several schedulers (workers) can share the same jobs.
+    # A run whose lease was broken by another worker is stopped and the job left to that worker.
+
+    # The jobs can belong to several domains: domains is the list of their configurations and job['domain'] the index
+    # of the domain of a job (0 if not set). The WN executable, configuration and resolution are those of the domain.
+
+    # With a workspace, the WN outputs of each job are written in its scratch directory, which is removed once the job
+    # is post-processed, and a job is only started if its intermediate files fit in the disk budget of the workspace.
+
+    # Jobs of virtual tiles (with dem_vrt) wait for the GeoTIFF of their tile, written in the post-processing pool in
+    # the order the jobs are started, for the next dem_lookahead tiles only so that the GeoTIFFs do not all take disk
+    # space at once. Without leases, the GeoTIFF is removed once the jobs of the tile are done.
+
+    # A WN run that fails or exceeds the time limit of its domain (job_timeout) is run again up to job_retries times,
+    # its configuration and log kept as WN_failed_<attempt>.cfg and .log. A job that still fails is given up and
+    # listed in failed, the other jobs carry on. With speculative_factor, once all the jobs are started, a run taking
+    # more than speculative_factor times its predicted time is started a second time on the idle cores: the first run
+    # to finish is kept and the other one killed.
+
+    # Number of distinct DEMs of virtual tiles materialized ahead of the jobs to run
+    dem_lookahead = 4
+
+    def __init__(self, domains, ncores, mem_budget, wn_threads=None, runtime_model=None, leases=None, npost=None,
+                 workspace=None, speculative_factor=None, gdal_prefix='', poll_interval=0.2):
+        self.domains = domains
+        self.npost = npost if npost is not None else max(1, ncores // 8)
+        # Cores of the WN runs: the post-processing workers have theirs
+        self.ncores = max(1, ncores - self.npost)
+        self.mem_budget = mem_budget
+        self.wn_threads = wn_threads
+        self.runtime_model = runtime_model if runtime_model is not None else RuntimeModel()
+        self.leases = leases
+        self.workspace = workspace
+        self.speculative_factor = speculative_factor
+        # Prefix of the GDAL tools, used to write the DEMs of virtual tiles without the GDAL bindings
+        self.gdal_prefix = gdal_prefix
+        self.poll_interval = poll_interval
+
+        # Wall time of each WN run
+        self.wn_times = []
+        # Record of each completed job: WN run (with the resource usage of the WN process) and post-processing
+        self.records = []
+        # Results of the finalization of each (domain, direction)
+        self.finalized = {}
+        # Number of failed runs of each (domain, job key) and jobs given up
+        self.attempts = {}
+        self.failed = []
+        # Timings of the GeoTIFFs written for virtual tiles
+        self.materialized = []
+
+    def domain(self, job):
+        return self.domains[job.get('domain', 0)]
+
+    def job_memory(self, job):
+        return job['ncells'] * self.domain(job)['wn_mem_per_cell']
+
+    def job_timeout(self, job):
+        cfg = self.domain(job)
+        if cfg['job_timeout'] is None:
+            return None
+        return cfg['job_timeout'] * max(job['ncells'] / float(cfg['max_tile_cells']), 0.1)
+
+    def release(self, job):
+        # Remove the WN files of a run once it is post-processed, failed or was overtaken by another run of the same
+        # job
+        if self.workspace is not None:
+            self.workspace.release(job)
+        else:
+            release_job_dir(job)
+
+    def fail(self, origin, job, reason):
+        # Count a failed attempt of a job: its WN run failed or timed out, its post-processing or the
+        # materialization of its DEM raised. The WN configuration and log of the attempt are kept next to the outputs
+        # and the files of the run (job, None if WN did not run) are removed. Returns True if the job is to be run
+        # again, False if it is given up
+        key = (origin.get('domain', 0), origin['key'])
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        name_failed = origin.get('output_base', origin['name_base']) + 'WN_failed_' + str(self.attempts[key])
+        fic_log = None
+        if job is not None:
+            if os.path.exists(job['name_base'] + 'WN.log'):
+                fic_log = name_failed + '.log'
+                shutil.copy(job['name_base'] + 'WN.log', fic_log)
+            if os.path.exists(job['name_base'] + 'cli_massSolver.cfg'):
+                shutil.copy(job['name_base'] + 'cli_massSolver.cfg', name_failed + '.cfg')
+            self.release(job)
+
+        name = 'tile_' + str(origin['i']) + '_' + str(origin['j']) + '_' + str(int(origin['wdir']))
+        see = '' if fic_log is None else f' See {fic_log}'
+        if self.attempts[key] <= self.domain(origin)['job_retries']:
+            print(f'WARNING: job {name} failed ({reason}), running it again.' + see)
+            return True
+
+        print(f'ERROR: job {name} failed ({reason}) {self.attempts[key]} times, giving up.' + see)
+        self.failed.append({'domain': origin.get('domain', 0), 'key': origin['key'],
+                            'i': origin['i'], 'j': origin['j'], 'wdir': origin['wdir'],
+                            'attempts': self.attempts[key], 'reason': reason, 'log': fic_log})
+        return False
+
+    def release_dem(self, job, dem_jobs, dem_futures):
+        # Remove the GeoTIFF written for a virtual tile once the last job of the tile is done. With leases, other
+        # workers may still use it
+        dem_jobs[job['dem']] -= 1
+        if dem_jobs[job['dem']] == 0 and job['dem'] in dem_futures and self.leases is None:
+            os.remove(job['dem'])
+
+    def base_threads(self, jobs):
+        # Threads per WN run when the queue is full
+        if self.wn_threads is not None:
+            return min(self.wn_threads, self.ncores)
+
+        # As many concurrent runs as there are jobs, cores and memory for. The cores left are given as threads
+        max_mem = max(self.job_memory(job) for job in jobs)
+        nconcurrent = min(len(jobs), self.ncores, max(1, int(self.mem_budget // max_mem)))
+        return max(1, self.ncores // nconcurrent)
+
+    def launch(self, job, nthreads):
+        cfg = self.domain(job)
+        if self.workspace is not None:
+            self.workspace.acquire(job)
+
+        # WN config with the number of threads of this run
+        fic_config = job['name_base'] + 'cli_massSolver.cfg'
+        write_wn_config(cfg['wn_config'], nthreads, fic_config)
+
+        cmd = [cfg['wn_exe'], fic_config,
+               '--elevation_file', job['dem'],
+               '--mesh_resolution', str(cfg['res_wind']),
+               '--input_direction', str(int(job['wdir'])),
+               '--output_path', job['dir']]
+
+        env = dict(environ)
+        env['WINDNINJA_DATA'] = os.path.join(os.path.dirname(cfg['wn_exe']), '..', 'share', 'windninja')
+
+        # WN outputs are kept in a log rather than a pipe that nobody reads
+        with open(job['name_base'] + 'WN.log', 'w') as log:
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+        return proc
+
+    def run(self, jobs, postprocess, finalize=None):
+        # postprocess: the post-processing function of the jobs of each domain
+        # finalize: optional function of each domain, called with a direction in the post-processing pool as soon as
+        # the last job of the direction is post-processed. WN runs, post-processing and finalization are pipelined
+        if len(jobs) == 0:
+            return []
+
+        nthreads = self.base_threads(jobs)
+
+        pending = self.runtime_model.sort(jobs)
+        running = []
+        post_futures = {}
+        finalize_futures = {}
+        results = []
+        t_start = time.time()
+
+        # Jobs left to post-process in each (domain, direction)
+        remaining = {}
+        for job in jobs:
+            direction = (job.get('domain', 0), job['wdir'])
+            remaining[direction] = remaining.get(direction, 0) + 1
+
+        # Jobs claimed by other workers. They are checked again once the pending jobs are all started, in case
+        # the worker running them died
+        waiting = []
+        last_check = time.time()
+
+        # Jobs waiting for the GeoTIFF of their virtual tile, and jobs left to run on each DEM
+        blocked = [job for job in pending if 'dem_vrt' in job and not os.path.exists(job['dem'])]
+        pending = [job for job in pending if job not in blocked]
+        dem_futures = {}
+        dem_jobs = {}
+        for job in jobs:
+            dem_jobs[job['dem']] = dem_jobs.get(job['dem'], 0) + 1
+
+        with futures.ProcessPoolExecutor(max_workers=self.npost) as executor, tqdm(total=len(jobs)) as pbar:
+            try:
+                while pending or running or post_futures or finalize_futures or waiting or blocked:
+                    # DEMs of the next jobs to run: those of the pending jobs are ready, the others are materialized
+                    upcoming = []
+                    for job in pending:
+                        if len(upcoming) >= self.dem_lookahead:
+                            break
+                        if 'dem_vrt' in job and job['dem'] not in upcoming:
+                            upcoming.append(job['dem'])
+                    for job in blocked:
+                        if len(upcoming) >= self.dem_lookahead:
+                            break
+                        if job['dem'] not in upcoming:
+                            upcoming.append(job['dem'])
+                            if job['dem'] not in dem_futures:
+                                dem_futures[job['dem']] = executor.submit(materialize_dem, job['dem_vrt'], job['dem'],
+                                                                              self.gdal_prefix)
+
+                    # Jobs whose DEM is ready
+                    ready = [(job, dem_futures[job['dem']]) for job in blocked
+                             if job['dem'] in dem_futures and dem_futures[job['dem']].done()]
+                    if ready:
+                        for job, f_dem in ready:
+                            if f_dem.exception() is None:
+                                blocked.remove(job)
+                                if f_dem.result() not in self.materialized:
+                                    self.materialized.append(f_dem.result())
+                                continue
+                            if self.fail(job, None, f'DEM: {f_dem.exception()!r}'):
+                                # Materialized again, once for all the jobs of the DEM
+                                if dem_futures.get(job['dem']) is f_dem:
+                                    del dem_futures[job['dem']]
+                            else:
+                                blocked.remove(job)
+                                if self.leases is not None:
+                                    self.leases.release(job)
+                                dem_jobs[job['dem']] -= 1
+                                pbar.update(1)
+                        ready = [job for job, f_dem in ready if f_dem.exception() is None]
+                        pending = self.runtime_model.sort(pending + ready)
+
+                    if self.leases is not None:
+                        # Runs of jobs whose lease was broken by another worker are stopped: the job is that worker's
+                        lost = self.leases.renew()
+                        for r in running:
+                            if r['origin']['key'] in lost and r['killed'] is None:
+                                r['proc'].kill()
+                                r['killed'] = 'lost'
+
+                        if not pending and waiting and time.time() - last_check > self.leases.check_interval:
+                            last_check = time.time()
+                            for job in list(waiting):
+                                if self.leases.is_done(job):
+                                    waiting.remove(job)
+                                    pbar.update(1)
+                                elif self.leases.claim(job):
+                                    waiting.remove(job)
+                                    pending.append(job)
+
+                    # Start as many WN runs as there are free cores and memory for
+                    free_cores = self.ncores - sum(r['threads'] for r in running)
+                    used_mem = sum(r['mem'] for r in running)
+                    while pending:
+                        job = pending[0]
+                        if self.leases is not None and not self.leases.is_held(job) and not self.leases.claim(job):
+                            pending.pop(0)
+                            if self.leases.is_done(job):
+                                pbar.update(1)
+                            else:
+                                waiting.append(job)
+                            continue
+                        mem = self.job_memory(job)
+                        # When the queue drains, the remaining jobs get the free cores
+                        threads = min(max(nthreads, free_cores // (len(pending) + len(blocked))), self.ncores)
+                        if running and (threads > free_cores or used_mem + mem > self.mem_budget):
+                            break
+                        if (running or post_futures) and self.workspace is not None and \
+                                not self.workspace.fits(job):
+                            break
+                        pending.pop(0)
+                        # Lane of the run in the timeline of the telemetry
+                        lane = min(set(range(len(running) + 1)) - set(r['lane'] for r in running))
+                        running.append({'proc': self.launch(job, threads), 'job': job, 'origin': job,
+                                        'threads': threads, 'mem': mem, 'start': time.time(), 'lane': lane,
+                                        'timeout': self.job_timeout(job), 'twin': None, 'killed': None})
+                        free_cores -= threads
+                        used_mem += mem
+
+                    # Second run of the stragglers on the idle cores, in their own directory
+                    if not pending and not waiting and not blocked and self.speculative_factor is not None:
+                        for r in sorted(running, key=lambda r: r['start']):
+                            job = r['job']
+                            if r['twin'] is not None or r['killed'] is not None or job.get('speculative') or \
+                                    time.time() - r['start'] < self.speculative_factor * \
+                                    self.runtime_model.predict(job) / r['threads']:
+                                continue
+                            spec_dir = job['dir'] + '_spec_' + str(int(job['wdir']))
+                            spec = dict(job, dir=spec_dir, speculative=True,
+                                        name_base=os.path.join(spec_dir, os.path.basename(job['name_base'])),
+                                        output_base=job.get('output_base', job['name_base']))
+                            if r['threads'] > free_cores or used_mem + r['mem'] > self.mem_budget or \
+                                    (self.workspace is not None and not self.workspace.fits(spec)):
+                                break
+                            os.makedirs(spec_dir, exist_ok=True)
+                            lane = min(set(range(len(running) + 1)) - set(r['lane'] for r in running))
+                            r_spec = {'proc': self.launch(spec, r['threads']), 'job': spec, 'origin': r['origin'],
+                                      'threads': r['threads'], 'mem': r['mem'], 'start': time.time(), 'lane': lane,
+                                      'timeout': self.job_timeout(spec), 'twin': r, 'killed': None}
+                            r['twin'] = r_spec
+                            running.append(r_spec)
+                            free_cores -= r['threads']
+                            used_mem += r['mem']
+
+                    # Post-process the WN runs that are done
+                    ndone = 0
+                    for r in list(running):
+                        proc, job = r['proc'], r['job']
+                        if r['timeout'] is not None and r['killed'] is None and time.time() - r['start'] > r['timeout']:
+                            proc.kill()
+                            r['killed'] = 'timeout'
+                        rusage = reap(proc)
+                        if rusage is None:
+                            continue
+                        running.remove(r)
+
+                        # The other run of the job finished first
+                        if r['killed'] == 'overtaken':
+                            self.release(job)
+                            continue
+
+                        # Job taken over by another worker, counted once it is done
+                        if r['killed'] == 'lost':
+                            self.release(job)
+                            if r['twin'] is not None:
+                                r['twin']['twin'] = None
+                            else:
+                                waiting.append(r['origin'])
+                            continue
+
+                        if proc.returncode != 0:
+                            if r['twin'] is not None:
+                                # The other run of the job carries on
+                                r['twin']['twin'] = None
+                                self.release(job)
+                                continue
+                            reason = 'WindNinja timeout' if r['killed'] == 'timeout' else \
+                                f'WindNinja exit code {proc.returncode}'
+                            origin = r['origin']
+                            if self.fail(origin, job, reason):
+                                pending.insert(0, origin)
+                            else:
+                                if self.leases is not None:
+                                    self.leases.release(origin)
+                                self.release_dem(origin, dem_jobs, dem_futures)
+                                pbar.update(1)
+                            continue
+
+                        # First run of the job to finish: the other one is killed
+                        if r['twin'] is not None:
+                            r['twin']['proc'].kill()
+                            r['twin']['killed'] = 'overtaken'
+                            r['twin']['twin'] = None
+                        if self.workspace is not None:
+                            self.workspace.observe(job)
+                        t_end = time.time()
+                        self.wn_times.append(t_end - r['start'])
+                        self.runtime_model.observe(job, self.wn_times[-1], r['threads'])
+                        record = {'name': 'tile_' + str(job['i']) + '_' + str(job['j']) + '_' + str(int(job['wdir'])),
+                                  'domain': job.get('domain', 0),
+                                  'i': job['i'], 'j': job['j'], 'wdir': job['wdir'], 'ncells': job['ncells'],
+                                  'threads': r['threads'], 'lane': r['lane'],
+                                  'speculative': job.get('speculative', False),
+                                  'attempts': self.attempts.get((job.get('domain', 0), job['key']), 0) + 1,
+                                  'queue_wait': r['start'] - t_start,
+                                  'wn_start': r['start'], 'wn_end': t_end,
+                                  'wn_cpu': rusage.ru_utime + rusage.ru_stime,
+                                  'wn_max_rss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                                  'wn_bytes_read': rusage.ru_inblock * 512,
+                                  'wn_bytes_written': rusage.ru_oublock * 512}
+                        f_post = executor.submit(postprocess[job.get('domain', 0)], job)
+                        post_futures[f_post] = (job, r['origin'], record)
+                        ndone += 1
+
+                    # Refine the order of the remaining jobs with the timings of this run
+                    if ndone and pending:
+                        self.runtime_model.fit()
+                        pending = self.runtime_model.sort(pending)
+
+                    if post_futures or finalize_futures:
+                        done, _ = futures.wait(list(post_futures) + list(finalize_futures), timeout=self.poll_interval,
+                                               return_when=futures.FIRST_COMPLETED)
+                        for f in done:
+                            if f in finalize_futures:
+                                self.finalized[finalize_futures.pop(f)] = f.result()
+                                continue
+
+                            job, origin, record = post_futures.pop(f)
+                            try:
+                                record['post'] = f.result()
+                            except Exception as e:
+                                # E.g., WN exited normally with missing or truncated outputs
+                                if self.fail(origin, job, f'post-processing: {e!r}'):
+                                    pending.insert(0, origin)
+                                else:
+                                    if self.leases is not None:
+                                        self.leases.release(job)
+                                    self.release_dem(job, dem_jobs, dem_futures)
+                                    pbar.update(1)
+                                continue
+                            results.append(record['post'])
+                            self.records.append(record)
+                            if self.leases is not None:
+                                self.leases.release(job)
+                            self.release(job)
+                            self.release_dem(job, dem_jobs, dem_futures)
+                            pbar.update(1)
+
+                            direction = (record['domain'], job['wdir'])
+                            remaining[direction] -= 1
+                            if finalize is not None and remaining[direction] == 0:
+                                f_final = executor.submit(finalize[direction[0]], job['wdir'])
+                                finalize_futures[f_final] = direction
+                    else:
+                        time.sleep(self.poll_interval)
+            except BaseException:
+                for r in running:
+                    r['proc'].kill()
+                if self.leases is not None:
+                    self.leases.release_all()
+                raise
+
+        return results
+
+
+class Workspace(object):
+    # Scratch space for the intermediate files of the WN runs, on a fast local disk (local SSD, tmpfs).
+    # Each job writes its WN outputs, configuration and log in its own directory of the workspace. The post-processing
+    # writes the final tifs in the output directory and the directory of the job is removed as soon as the job is
+    # post-processed. In a run in a single process, the DEMs of the tiles are also moved to the workspace (hold_dem).
+    # The disk space of a job is estimated from its number of cells, with the largest footprint per cell seen so far.
+
+    # Initial estimate of the disk space of a job, in bytes per cell
+    disk_per_cell = 100.
+
+    def __init__(self, scratch_dir, budget=None, disk_per_cell=None):
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix='windmapper_', dir=scratch_dir)
+        self.budget = budget
+        if disk_per_cell is not None:
+            self.disk_per_cell = disk_per_cell
+        # Disk space used by the jobs started and not yet post-processed
+        self.used = {}
+        # DEMs of the tiles held in the workspace, by their path in the output directory
+        self.dems = {}
+
+    def hold_dem(self, fic, domain=0):
+        # Move the DEM of a tile to the workspace, where the WN runs read it. A DEM written later (virtual tiles) is
+        # written directly in the workspace. WN names its outputs after the DEM: the DEM keeps its name, in a
+        # directory per domain
+        dem_dir = os.path.join(self.root, 'dem_' + str(domain))
+        os.makedirs(dem_dir, exist_ok=True)
+        fic_held = os.path.join(dem_dir, os.path.basename(fic))
+        if os.path.exists(fic):
+            shutil.move(fic, fic_held)
+        self.dems[fic] = fic_held
+
+    def place(self, job):
+        # Same job, with its WN outputs (and its DEM, if held) in the workspace
+        job_dir = os.path.join(self.root, str(job.get('domain', 0)) + '_' + job['key'])
+        return dict(job, dir=job_dir, name_base=os.path.join(job_dir, os.path.basename(job['name_base'])),
+                    output_base=job['name_base'], dem=self.dems.get(job['dem'], job['dem']))
+
+    def job_disk(self, job):
+        return job['ncells'] * self.disk_per_cell
+
+    def fits(self, job):
+        return self.budget is None or sum(self.used.values()) + self.job_disk(job) <= self.budget
+
+    def acquire(self, job):
+        os.makedirs(job['dir'], exist_ok=True)
+        self.used[job['dir']] = self.job_disk(job)
+
+    def observe(self, job):
+        # Size of the WN outputs of a job
+        size = sum(os.path.getsize(os.path.join(job['dir'], f)) for f in os.listdir(job['dir']))
+        self.used[job['dir']] = size
+        self.disk_per_cell = max(self.disk_per_cell, size / float(job['ncells']))
+
+    def release(self, job):
+        release_job_dir(job)
+        self.used.pop(job['dir'], None)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class JobLeases(object):
+    # Claims on the jobs of a manifest shared by several workers, through lock files on a shared file system.
+    # A worker holds a lease on a job while it runs it and renews it regularly. A lease that has not been renewed
+    # for lease_timeout seconds belongs to a dead worker: the lease is broken and the job can be claimed again.
+
+    def __init__(self, lease_dir, cache_dir, lease_timeout=600.):
+        self.lease_dir = lease_dir
+        self.cache_dir = cache_dir
+        self.lease_timeout = lease_timeout
+        self.check_interval = lease_timeout / 10.
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.held = set()
+        self.last_renew = time.time()
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def path(self, job):
+        return os.path.join(self.lease_dir, job['key'] + '.lock')
+
+    def is_done(self, job):
+        return is_job_cached(self.cache_dir, job['key'])
+
+    def is_held(self, job):
+        return job['key'] in self.held
+
+    def claim(self, job):
+        if self.is_done(job):
+            return False
+
+        fic = self.path(job)
+        try:
+            age = time.time() - os.path.getmtime(fic)
+        except FileNotFoundError:
+            age = None
+
+        if age is not None:
+            if age < self.lease_timeout:
+                return False
+
+            # Break the stale lease. Only one worker can move it away
+            fic_stale = fic + '.' + uuid.uuid4().hex + '.stale'
+            try:
+                os.rename(fic, fic_stale)
+            except FileNotFoundError:
+                return False
+
+            # Another worker may have broken the stale lease and claimed the job in the meantime. In that case its
+            # fresh lease is put back
+            if time.time() - os.path.getmtime(fic_stale) < self.lease_timeout:
+                try:
+                    os.link(fic_stale, fic)
+                except FileExistsError:
+                    pass
+                os.remove(fic_stale)
+                return False
+            os.remove(fic_stale)
+
+        try:
+            fd = os.open(fic, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fic_file:
+            fic_file.write(self.owner)
+        self.held.add(job['key'])
+
+        # The job may have been completed by another worker between the check and the claim
+        if self.is_done(job):
+            self.release(job)
+            return False
+
+        return True
+
+    def owns(self, key):
+        # A lease broken by another worker belongs to that worker
+        try:
+            with open(os.path.join(self.lease_dir, key + '.lock')) as fic_file:
+                return fic_file.read() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def renew(self):
+        # Returns the keys of the jobs whose lease was broken by another worker (e.g., this worker was stalled for
+        # more than lease_timeout). They are no longer held
+        if time.time() - self.last_renew < self.check_interval:
+            return set()
+
+        self.last_renew = time.time()
+        lost = set()
+        for key in list(self.held):
+            if not self.owns(key):
+                self.held.discard(key)
+                lost.add(key)
+                continue
+            try:
+                os.utime(os.path.join(self.lease_dir, key + '.lock'))
+            except FileNotFoundError:
+                pass
+        if lost:
+            print(f'WARNING: {len(lost)} jobs were taken over by another worker.')
+        return lost
+
+    def release(self, job):
+        self.held.discard(job['key'])
+        if not self.owns(job['key']):
+            return
+        try:
+            os.remove(self.path(job))
+        except FileNotFoundError:
+            pass
+
+    def release_all(self):
+        for key in list(self.held):
+            self.release({'key': key})
+
+
+class RuntimeModel(object):
+    # Model of the cost of a WN run in core-seconds (wall time x threads): a * ncells + b * ncells * roughness
+    # with ncells the number of cells of the WN mesh and roughness the mean slope of the tile.
+    # The coefficients are fitted on the timings of past runs, stored in a json file, and on the timings of the
+    # current run as they are measured.
+
+    # Number of timings kept in the file
+    max_observations = 1000
+
+    def __init__(self, fic=None):
+        self.fic = fic
+        self.observations = []
+        # Prior used until there are enough timings
+        self.coefs = [1e-3, 1e-3]
+
+        if fic is not None and os.path.exists(fic):
+            try:
+                with open(fic) as fic_file:
+                    self.observations = json.load(fic_file)['observations']
+            except (ValueError, KeyError):
+                print(f'WARNING: Ignoring invalid runtime model file {fic}')
+        self.fit()
+
+    def predict(self, job):
+        return self.coefs[0] * job['ncells'] + self.coefs[1] * job['ncells'] * job.get('roughness', 0.)
+
+    def sort(self, jobs):
+        # Longest jobs first
+        return sorted(jobs, key=self.predict, reverse=True)
+
+    def observe(self, job, elapsed, nthreads):
+        self.observations.append([job['ncells'], job.get('roughness', 0.), elapsed * nthreads])
+        self.observations = self.observations[-self.max_observations:]
+
+    def fit(self):
+        if len(self.observations) == 0:
+            return
+
+        obs = np.array(self.observations, dtype=np.float64)
+        ncells, roughness, cost = obs[:, 0], obs[:, 1], obs[:, 2]
+        features = np.stack([ncells, ncells * roughness], axis=1)
+
+        coefs = None
+        if len(obs) >= 5 and np.ptp(roughness) > 0:
+            coefs, _, _, _ = np.linalg.lstsq(features, cost, rcond=None)
+            if np.any(coefs < 0):
+                coefs = None
+
+        if coefs is None:
+            # Not enough timings to separate the effect of roughness: only scale the current model
+            pred = features.dot(self.coefs)
+            coefs = np.array(self.coefs) * (cost.sum() / pred.sum() if pred.sum() > 0 else 1.)
+
+        self.coefs = [float(c) for c in coefs]
+
+    def save(self):
+        if self.fic is None:
+            return
+
+        dirname = os.path.dirname(os.path.abspath(self.fic))
+        os.makedirs(dirname, exist_ok=True)
+        fd, fic_tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fic_file:
+            json.dump({'coefs': self.coefs, 'observations': self.observations}, fic_file)
+        os.replace(fic_tmp, self.fic)
+
+
+class DEMCache(object):
+    # Persistent cache of the DEMs warped to UTM, shared by the runs of a machine (or of a cluster, on a shared file
+    # system). A DEM is keyed by its source, EPSG code, resolution and bounds, and is used for any request of the
+    # same source, EPSG code and resolution whose bounds are inside its own. The least recently used DEMs are
+    # removed once the cache is larger than max_size (in bytes).
+    # The index is only read and written under a lock file, which works on shared file systems. A run reads a cached
+    # DEM through its own hard link to it (released once read), so that the DEM can be evicted by another run
+    # meanwhile.
+
+    # A lock older than this (in s) was left by a dead process and is broken
+    lock_timeout = 60.
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.fic_index = os.path.join(cache_dir, 'index.json')
+        self.fic_lock = os.path.join(cache_dir, 'index.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self):
+        while True:
+            try:
+                fd = os.open(self.fic_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                break
+            except FileExistsError:
+                pass
+
+            # Break a stale lock. Only one process can move it away
+            try:
+                if time.time() - os.path.getmtime(self.fic_lock) > self.lock_timeout:
+                    fic_stale = self.fic_lock + '.' + uuid.uuid4().hex + '.stale'
+                    os.rename(self.fic_lock, fic_stale)
+                    os.remove(fic_stale)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+
+        try:
+            yield
+        finally:
+            try:
+                os.remove(self.fic_lock)
+            except FileNotFoundError:
+                pass
+
+    def reference(self, name):
+        # Hard link to a cached DEM for this run, or the DEM itself if the file system has no hard links
+        fic = os.path.join(self.cache_dir, name)
+        fic_ref = os.path.join(self.cache_dir, 'ref_' + str(int(time.time())) + '_' + uuid.uuid4().hex + '_' + name)
+        try:
+            os.link(fic, fic_ref)
+        except OSError:
+            return fic
+        return fic_ref
+
+    def release(self, fic):
+        if os.path.basename(fic).startswith('ref_'):
+            os.remove(fic)
+
+    def load(self):
+        if not os.path.exists(self.fic_index):
+            return []
+        with open(self.fic_index) as fic_file:
+            entries = json.load(fic_file)
+        # DEMs removed by hand are forgotten
+        return [e for e in entries if os.path.exists(os.path.join(self.cache_dir, e['file']))]
+
+    def save(self, entries):
+        fd, fic_tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fic_file:
+            json.dump(entries, fic_file, indent=2)
+        os.replace(fic_tmp, self.fic_index)
+
+    def find(self, source, epsg, res, bounds):
+        # Reference to a cached DEM that covers bounds = [xmin, ymin, xmax, ymax], None if there is none. The
+        # reference is to be released once read
+        with self.lock():
+            entries = self.load()
+            for e in entries:
+                b = e['bounds']
+                if e['source'] == source and e['epsg'] == epsg and e['res'] == res and \
+                        b[0] <= bounds[0] and b[1] <= bounds[1] and b[2] >= bounds[2] and b[3] >= bounds[3]:
+                    e['last_used'] = time.time()
+                    self.save(entries)
+                    return self.reference(e['file'])
+
+        return None
+
+    def add(self, fic, source, epsg, res, bounds):
+        # Move the DEM fic to the cache. Returns a reference to it, to be released once read
+        key = hashlib.sha256(json.dumps([source, epsg, res, list(bounds)]).encode()).hexdigest()
+        name = 'dem_' + str(epsg) + '_' + key[:16] + '.tif'
+
+        with self.lock():
+            os.replace(fic, os.path.join(self.cache_dir, name))
+            fic_ref = self.reference(name)
+
+            entries = [e for e in self.load() if e['file'] != name]
+            entries.append({'file': name, 'source': source, 'epsg': epsg, 'res': res,
+                            'bounds': [float(b) for b in bounds],
+                            'size': os.path.getsize(os.path.join(self.cache_dir, name)), 'last_used': time.time()})
+
+            # Evict the least recently used DEMs, but never the one just added. Runs reading an evicted DEM keep
+            # their reference to it
+            entries.sort(key=lambda e: e['last_used'])
+            while len(entries) > 1 and sum(e['size'] for e in entries) > self.max_size:
+                os.remove(os.path.join(self.cache_dir, entries.pop(0)['file']))
+            self.save(entries)
+
+            # References left by dead runs, by the time in their name (a hard link has the time of the DEM)
+            for f in os.listdir(self.cache_dir):
+                if f.startswith('ref_') and time.time() - int(f.split('_')[1]) > 86400.:
+                    os.remove(os.path.join(self.cache_dir, f))
+
+        return fic_ref
+
+
+def release_job_dir(job):
+    # Remove the WN files of a job run: its own directory for a run out of the tile directory (workspace,
+    # speculative run), its WN outputs, configuration and log otherwise. The final tifs are kept
+    if 'output_base' in job:
+        shutil.rmtree(job['dir'], ignore_errors=True)
+        return
+    for suffix in ['ang.asc', 'ang.prj', 'vel.asc', 'vel.prj', 'cli_massSolver.cfg', 'WN.log']:
+        if os.path.exists(job['name_base'] + suffix):
+            os.remove(job['name_base'] + suffix)
+
+
+def tile_stats(fic, terrain=False):
+    # Statistics of the DEM of a tile, from a single read: hash of its content (values, georeferencing and projection),
+    # roughness (mean slope, m/m) and, with terrain, fraction of nodata, elevation range (m) and 99.9th percentile of
+    # the slope (m/m)
+    ds = gdal.Open(fic)
+    gt = ds.GetGeoTransform()
+    h = hashlib.sha256()
+    h.update(repr(gt).encode())
+    h.update(ds.GetProjection().encode())
+    for b in range(1, ds.RasterCount + 1):
+        data = ds.GetRasterBand(b).ReadAsArray()
+        h.update(data.tobytes())
+        if b == 1:
+            z = data.astype(np.float32)
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    ds = None
+
+    stats = {'hash': h.hexdigest(), 'roughness': 0.}
+    slope = None
+    if min(z.shape) >= 2:
+        dzdy, dzdx = np.gradient(z, -gt[5], gt[1])
+        slope = np.hypot(dzdx, dzdy)
+        stats['roughness'] = float(np.mean(slope))
+    if not terrain:
+        return stats
+
+    # Nodata is left out of the terrain statistics (but not of the roughness, as before)
+    if nodata is not None:
+        z[z == nodata] = np.nan
+    valid = np.isfinite(z)
+    stats['terrain'] = {'nodata': float(1. - valid.mean()), 'relief': 0., 'slope_p999': 0.}
+    if not valid.any():
+        return stats
+
+    stats['terrain']['relief'] = float(np.nanmax(z) - np.nanmin(z))
+    if slope is not None:
+        # Slope without the nodata
+        dzdy, dzdx = np.gradient(z, -gt[5], gt[1])
+        slope = np.hypot(dzdx, dzdy)
+        if np.isfinite(slope).any():
+            stats['terrain']['slope_p999'] = float(np.nanpercentile(slope, 99.9))
+    return stats
+
+
+def is_trivial_tile(cfg, terrain):
+    return terrain['nodata'] >= cfg['trivial_nodata'] or \
+        (terrain['relief'] <= cfg['trivial_relief'] and terrain['slope_p999'] <= cfg['trivial_slope'])
+
+
+def write_trivial_tile(cfg, tile, wdir):
+    # Outputs of a trivial tile for direction wdir, on the grid the WN run would have: the input wind from wdir
+    # everywhere, with a speed up of 1
+    res_wind = cfg['res_wind']
+    input_speed = 10.
+    match = re.search(r'^\s*input_speed\s*=\s*([0-9.eE+-]+)', cfg['wn_config'], flags=re.MULTILINE)
+    if match is not None:
+        input_speed = float(match.group(1))
+
+    ds = gdal.Open(tile_dem(cfg, tile))
+    proj = ds.GetProjection()
+    ds = None
+
+    # WN grid of the tile, reduced to the interior of the tile
+    xmin, xmax, ymin, ymax = tile['extent']
+    ncols = max(1, int(round((xmax - xmin) / res_wind)))
+    nrows = max(1, int(round((ymax - ymin) / res_wind)))
+    gt = (xmin, res_wind, 0., ymin + nrows * res_wind, 0., -res_wind)
+    x0, x1, y0, y1 = tile['interior']
+    xoff, yoff, xsize, ysize = projwin_to_window(gt, (nrows, ncols), [x0, y1, x1, y0])
+    gt_window = (gt[0] + xoff * gt[1], gt[1], 0., gt[3] + yoff * gt[5], 0., gt[5])
+
+    rad = np.radians(wdir)
+    values = [-input_speed * np.sin(rad), -input_speed * np.cos(rad), 1.]
+    name_base = wn_name_base(cfg['user_output_dir'], tile['i'], tile['j'], wdir, res_wind)
+    for var, value in zip(cfg['list_tif_2_vrt'], values):
+        save_tif(np.full((ysize, xsize), value, dtype=np.float32), gt_window, proj, name_base + var + '.tif')
+
+
+def reap(proc):
+    # Non-blocking wait for a child process. Returns its resource usage once it is complete (and sets its return
+    # code), None while it runs
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def available_cores():
+    ncores = os.cpu_count() or 1
+
+    # on linux we can ensure that we respect cpu affinity
+    if 'sched_getaffinity' in dir(os):
+        ncores = len(os.sched_getaffinity(0))
+
+    return ncores
+
+
+def available_memory():
+    # Physical memory in bytes
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 ** 3
+
+
+def write_wn_config(wn_config, nthreads, fic):
+    # Copy of the WN configuration with num_threads set to nthreads
+    config = re.sub(r'^\s*num_threads\s*=.*$', '', wn_config, flags=re.MULTILINE)
+    with open(fic, 'w') as fic_file:
+        fic_file.write(f'num_threads = {nthreads}\n' + config)
+
+
+def plan_tiles(xmin, ymax, ncols, nrows, pixel_width, pixel_height, res_wind, nadd, max_tile_cells, ndirs):
+    # Choose the number of tiles in x and y that minimizes the estimated WN cost of the library.
+    # The cost of a WN run is taken as the number of cells of its mesh, overlap included, plus a fixed overhead per
+    # run. Tiles are sized so that every tile has the same number of cells (edge tiles have an overlap on one side
+    # only, so they get a larger interior) and no tile is larger than max_tile_cells.
+
+    # Fixed cost of a WN run (mesh generation, start up), in number of cells
+    overhead_cells = 20000
+
+    # Size of the domain and of the overlap in WN cells
+    scale_x = pixel_width / res_wind
+    scale_y = pixel_height / res_wind
+    wn_x = ncols * scale_x
+    wn_y = nrows * scale_y
+
+    def tile_size(n, h, ntiles):
+        # Size of a tile with its overlap when n cells are split into ntiles tiles with an overlap h
+        if ntiles == 1:
+            return n
+        interior = (n - 2. * h) / ntiles
+        if interior <= 0:
+            return None
+        return interior + 2. * h
+
+    best = None
+    max_x = int(np.ceil(wn_x)) + 1
+    for nopt_x in range(1, max_x + 1):
+        size_x = tile_size(wn_x, nadd * scale_x, nopt_x)
+        if size_x is None:
+            break
+
+        # Tiles in y cannot be smaller than their overlap: with tiles this wide in x, no nopt_y fits
+        if max_tile_cells / size_x <= 2. * nadd * scale_y and wn_y * size_x > max_tile_cells:
+            continue
+
+        # For a given nopt_x, the smallest nopt_y that gives valid tiles has the lowest cost
+        nopt_y = max(1, int(np.ceil(wn_y * size_x / max_tile_cells)) - 1)
+        while True:
+            size_y = tile_size(wn_y, nadd * scale_y, nopt_y)
+            if size_y is None or size_x * size_y <= max_tile_cells:
+                break
+            nopt_y += 1
+        if size_y is None:
+            continue
+
+        cost = ndirs * nopt_x * nopt_y * (size_x * size_y + overhead_cells)
+        if best is None or cost < best[0]:
+            best = (cost, nopt_x, nopt_y)
+
+        # Tiles that are only overlap, no point going further
+        if size_x <= 2 * nadd * scale_x + 1:
+            break
+
+    if best is None:
+        return None
+
+    cost, nopt_x, nopt_y = best
+
+    def bounds(n, h, ntiles):
+        # Pixel bounds of the interior and of the extent (with overlap) of each tile
+        if ntiles == 1:
+            return [((0., n), (0., n))]
+        interior = (n - 2. * h) / ntiles
+        edges = [0.] + [h + interior * (k + 1) for k in range(ntiles - 1)] + [float(n)]
+        return [((edges[k], edges[k + 1]), (max(0., edges[k] - h), min(float(n), edges[k + 1] + h)))
+                for k in range(ntiles)]
+
+    tiles = []
+    for i, (interior_x, extent_x) in enumerate(bounds(ncols, nadd, nopt_x)):
+        for j, (interior_y, extent_y) in enumerate(bounds(nrows, nadd, nopt_y)):
+            # j = 0 is the southern row
+            def geo(px, py):
+                return [xmin + px[0] * pixel_width, xmin + px[1] * pixel_width,
+                        ymax - (nrows - py[0]) * pixel_height, ymax - (nrows - py[1]) * pixel_height]
+
+            tiles.append({'i': i,
+                          'j': j,
+                          'name': 'tmp_' + str(i) + "_" + str(j),
+                          'interior': geo(interior_x, interior_y),
+                          'extent': geo(extent_x, extent_y),
+                          'wn_cells': int(round((extent_x[1] - extent_x[0]) * scale_x *
+                                                (extent_y[1] - extent_y[0]) * scale_y))})
+
+    return {'nopt_x': nopt_x,
+            'nopt_y': nopt_y,
+            'nadd': nadd,
+            'res_wind': res_wind,
+            'ndirs': ndirs,
+            'max_tile_cells': max_tile_cells,
+            'estimated_cost': cost,
+            'tiles': tiles}
+
+
+def grid_tiles(xmin, ymax, ncols, nrows, pixel_width, pixel_height, res_wind, nadd, tile_size):
+    # Tiles of a global grid: the interiors are the cells of size tile_size (in m) of a grid anchored at the origin
+    # of the coordinate system, limited to the domain, with an overlap of nadd pixels. A tile is named after its
+    # position in the global grid, so that it has the same name and the same DEM in all the domains that contain it
+    # (edge tiles excepted)
+    xmax = xmin + ncols * pixel_width
+    ymin = ymax - nrows * pixel_height
+    hx = nadd * pixel_width
+    hy = nadd * pixel_height
+
+    range_x = range(int(np.floor(xmin / tile_size)), int(np.ceil(xmax / tile_size)))
+    range_y = range(int(np.floor(ymin / tile_size)), int(np.ceil(ymax / tile_size)))
+
+    tiles = []
+    for i in range_x:
+        for j in range_y:
+            interior = [max(xmin, i * tile_size), min(xmax, (i + 1) * tile_size),
+                        max(ymin, j * tile_size), min(ymax, (j + 1) * tile_size)]
+            extent = [max(xmin, interior[0] - hx), min(xmax, interior[1] + hx),
+                      max(ymin, interior[2] - hy), min(ymax, interior[3] + hy)]
+            tiles.append({'i': i,
+                          'j': j,
+                          'name': 'tmp_' + str(i) + "_" + str(j),
+                          'interior': interior,
+                          'extent': extent,
+                          'wn_cells': int(round((extent[1] - extent[0]) * (extent[3] - extent[2]) / res_wind ** 2))})
+
+    return {'nopt_x': len(range_x),
+            'nopt_y': len(range_y),
+            'nadd': nadd,
+            'res_wind': res_wind,
+            'tile_grid': tile_size,
+            'tiles': tiles}
+
+
+def call_WN_1dir(user_output_dir, list_tif_2_vrt, res_wind, targ_res, wind_average, cache_dir, job):
+    # Post-processing of the WN outputs for tile i,j and direction wdir
+    # The WN outputs are read once and each final tif is written once, already reduced to the extent of the tile
+    # Returns the start and end times, the CPU time and the bytes read and written by the post-processing
+    t_start = time.time()
+    cpu_start = time.process_time()
+    i, j, wdir, key = job['i'], job['j'], job['wdir'], job['key']
+
+    # The WN outputs are in the output directory or in the scratch workspace (job['name_base'])
+    name_base = wn_name_base(user_output_dir, i, j, wdir, res_wind)
+    wn_base = job['name_base']
+    bytes_read = sum(os.path.getsize(wn_base + var + '.asc') for var in ['ang', 'vel'])
+
+    # Read angle and velocity in float32
+    ang, gt = read_asc(wn_base + 'ang.asc')
+    vel, gt = read_asc(wn_base + 'vel.asc')
+    for var in ['ang', 'vel']:
+        os.remove(wn_base + var + '.asc')
+        os.remove(wn_base + var + '.prj')
+
+    ds = gdal.Open(job['dem'])
+    proj = ds.GetProjection()
+    ds = None
+
+    # Compute wind components, reusing the angle array
+    rad = np.radians(ang, out=ang)
+    uu = np.sin(rad)
+    uu *= vel
+    np.negative(uu, out=uu)
+    vv = np.cos(rad, out=rad)
+    vv *= vel
+    np.negative(vv, out=vv)
+
+    # Compute smooth wind speed and local speed up, reusing the velocity array
     if wind_average == 'grid':
         nsize = targ_res / res_wind
-        vv_large = ndimage.uniform_filter(vel, size=nsize, mode='nearest')
-        fic_tif = name_base + 'spd_up_' + str(targ_res) + '_large.tif'
+        vv_large = ndimage.uniform_filter(vel, size=nsize, mode='nearest', output=np.float32)
+        loc_speed_up = np.divide(vel, vv_large, out=vv_large)
     elif wind_average == 'mean_tile':
-        vv_large = np.mean(vel)
-        fic_tif = name_base + 'spd_up_tile_large.tif'
-    # Compute local speed up and save
-    loc_speed_up = vel / vv_large
-    save_tif(loc_speed_up, vel_tif, fic_tif)
-    # Reduce the extent of the final tif
-    xbeg = xmin + i * nx * pixel_width
-    ybeg = ymin + j * ny * pixel_height
-    delx = nx * pixel_width
-    dely = ny * pixel_height
-    for var in list_tif_2_vrt:
-        fic_tif = name_base + var + '_large.tif'
-        fic_tif_fin = name_base + var + '.tif'
-        if nopt_x == 1 and nopt_y == 1:
-            shutil.copy(fic_tif, fic_tif_fin)
+        vv_large = np.mean(vel, dtype=np.float64)
+        loc_speed_up = np.divide(vel, np.float32(vv_large), out=vel)
+    del vel
+
+    # Reduce the extent of the final tif to the tile without the overlap
+    x0, x1, y0, y1 = job['interior']
+    window = projwin_to_window(gt, uu.shape, [x0, y1, x1, y0])
+
+    xoff, yoff, xsize, ysize = window
+    gt_window = (gt[0] + xoff * gt[1], gt[1], 0., gt[3] + yoff * gt[5], 0., gt[5])
+    for var, data in zip(list_tif_2_vrt, [uu, vv, loc_speed_up]):
+        save_tif(data[yoff:yoff + ysize, xoff:xoff + xsize], gt_window, proj, name_base + var + '.tif')
+
+    # The job only counts as done once all its outputs are on disk
+    cache_job(cache_dir, key, {'i': i, 'j': j, 'wdir': float(wdir),
+                               'outputs': [name_base + var + '.tif' for var in list_tif_2_vrt]})
+
+    return {'start': t_start, 'end': time.time(), 'cpu': time.process_time() - cpu_start, 'pid': os.getpid(),
+            'bytes_read': bytes_read,
+            'bytes_written': sum(os.path.getsize(name_base + var + '.tif') for var in list_tif_2_vrt)}
+
+
+def read_asc(fic):
+    # Read an ESRI ASCII grid as written by WN. Returns the values in float32 and the geotransform
+    header = {}
+    with open(fic) as fic_file:
+        while True:
+            pos = fic_file.tell()
+            line = fic_file.readline()
+            tokens = line.split()
+            if len(tokens) != 2 or not tokens[0][0].isalpha():
+                fic_file.seek(pos)
+                break
+            header[tokens[0].lower()] = float(tokens[1])
+        data = np.fromstring(fic_file.read(), dtype=np.float32, sep=' ')
+
+    ncols = int(header['ncols'])
+    nrows = int(header['nrows'])
+    cellsize = header['cellsize']
+    if 'xllcorner' in header:
+        xll = header['xllcorner']
+        yll = header['yllcorner']
+    else:
+        xll = header['xllcenter'] - cellsize / 2.
+        yll = header['yllcenter'] - cellsize / 2.
+
+    gt = (xll, cellsize, 0., yll + nrows * cellsize, 0., -cellsize)
+    return data.reshape(nrows, ncols), gt
+
+
+def projwin_to_window(gt, shape, projwin):
+    # Pixel window (xoff, yoff, xsize, ysize) of projwin = [ulx, uly, lrx, lry] in a raster
+    # Rounded as gdal_translate -projwin does and limited to the raster extent
+    ulx, uly, lrx, lry = projwin
+    xoff = int(np.floor((ulx - gt[0]) / gt[1] + 0.001))
+    yoff = int(np.floor((uly - gt[3]) / gt[5] + 0.001))
+    xsize = int(np.floor((lrx - ulx) / gt[1] + 0.5))
+    ysize = int(np.floor((lry - uly) / gt[5] + 0.5))
+
+    xend = min(xoff + xsize, shape[1])
+    yend = min(yoff + ysize, shape[0])
+    xoff = max(xoff, 0)
+    yoff = max(yoff, 0)
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def wn_name_base(user_output_dir, i, j, wdir, res_wind):
+    # Prefix of the WN outputs for tile i,j and direction wdir
+    dir_tmp = user_output_dir + 'tmp_dir' + "_" + str(i) + "_" + str(j)
+    name_tmp = 'tmp_' + str(i) + "_" + str(j)
+    return dir_tmp + '/' + name_tmp + '_' + str(int(wdir)) + '_10_' + str(res_wind) + 'm_'
+
+
+def clean_output_dir(user_output_dir):
+    # Remove everything regenerated by a run (DEMs, tiles, vrts), but keep the job cache and the WN outputs
+    for entry in os.listdir(user_output_dir):
+        path = os.path.join(user_output_dir, entry)
+        if os.path.isdir(path):
+            if entry not in ['cache', 'leases'] and not entry.startswith('tmp_dir_'):
+                shutil.rmtree(path, ignore_errors=True)
         else:
-            clip_tif(fic_tif, fic_tif_fin, xbeg, xbeg + delx, ybeg, ybeg + dely, gdal_prefix)
-        os.remove(fic_tif)
+            os.remove(path)
+
+
+def hash_wn_config(fic_config):
+    # Hash of the WN configuration. num_threads and comments do not change the solution and are ignored
+    lines = []
+    for line in fic_config.splitlines():
+        line = line.split('#')[0].strip()
+        if line and not line.startswith('num_threads'):
+            lines.append(' '.join(line.split()))
+    return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+
+def job_key(tile_hash, wdir, res_wind, wn_config_hash, wind_average, targ_res):
+    key = json.dumps([tile_hash, float(wdir), res_wind, wn_config_hash, wind_average, targ_res])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def is_job_cached(cache_dir, key):
+    fic = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(fic):
+        return False
+
+    try:
+        with open(fic) as fic_file:
+            entry = json.load(fic_file)
+    except ValueError:
+        return False
+
+    if not all(os.path.exists(f) for f in entry['outputs']):
+        return False
+
+    # The outputs are named after their tile and direction, not after the key: outputs written since by a job of
+    # another key (e.g., a run resumed with another WN configuration) invalidate the entry
+    return 'stats' not in entry or entry['stats'] == [output_stat(f) for f in entry['outputs']]
+
+
+def output_stat(fic):
+    st = os.stat(fic)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def cache_job(cache_dir, key, entry):
+    entry = dict(entry, stats=[output_stat(f) for f in entry['outputs']])
 
+    # Write to a temporary file and rename it so a partially written entry is never seen as a completed job
+    fd, fic_tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fic_file:
+        json.dump(entry, fic_file)
+        fic_file.flush()
+        os.fsync(fic_file.fileno())
+    os.replace(fic_tmp, os.path.join(cache_dir, key + '.json'))
 
-def clip_tif(fic_in, fic_out, xmin, xmax, ymin, ymax, gdal_prefix):
-    com_string = gdal_prefix + "gdal_translate -of GTIFF -projwin " + str(xmin) + ", " + str(ymax) + ", " + str(xmax) + ", " + str(
-        ymin) + " " + fic_in + " " + fic_out
-    subprocess.check_call([com_string], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    # A job that failed in a previous run is done now
+    if os.path.exists(os.path.join(cache_dir, key + '.failed')):
+        os.remove(os.path.join(cache_dir, key + '.failed'))
 
 
-def save_tif(var, inDs, fic):
-    # Create the geotif
-    driver = inDs.GetDriver()
-    rows = inDs.RasterYSize
-    cols = inDs.RasterXSize
+def record_failure(cache_dir, key, entry):
+    # Mark a job as failed permanently. The mark is removed once the job is done, e.g., by a resumed run
+    with open(os.path.join(cache_dir, key + '.failed'), 'w') as fic_file:
+        json.dump(entry, fic_file)
+
+
+def is_job_failed(cache_dir, key):
+    return os.path.exists(os.path.join(cache_dir, key + '.failed'))
+
+
+def write_failure_report(manifest, failed):
+    # List of the jobs that failed permanently in user_output_dir/failed_jobs.json. Their tiles are missing from
+    # the outputs of their direction
+    fic_report = manifest['config']['user_output_dir'] + 'failed_jobs.json'
+    if not failed:
+        if os.path.exists(fic_report):
+            os.remove(fic_report)
+        return
+
+    report = []
+    for job in failed:
+        with open(os.path.join(manifest['cache_dir'], job['key'] + '.failed')) as fic_file:
+            report.append(json.load(fic_file))
+    with open(fic_report, 'w') as fic_file:
+        json.dump(report, fic_file, indent=2)
+    print(f'WARNING: {len(failed)} jobs failed, their tiles are missing from the library. See {fic_report}')
+
+
+# Raster I/O
+# The GDAL utilities are called in-process through the python bindings. This avoids starting a shell and a
+# gdal_translate process for every file. The command line tools are only used if the bindings are too old
+# to provide them (GDAL < 2.1).
+use_gdal_bindings = hasattr(gdal, 'Translate') and hasattr(gdal, 'BuildVRT') and hasattr(gdal, 'Warp')
+
+
+def run_gdal_tool(cmd):
+    # Run a GDAL command line tool. The outputs are read, so a verbose tool cannot block on a full pipe
+    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+
+def translate_tif(fic_in, fic_out, gdal_prefix, projwin=None, srcwin=None, output_format='GTiff'):
+    # Convert fic_in to a GeoTIFF (or output_format, e.g. VRT), optionally restricted to projwin = [ulx, uly, lrx, lry]
+    # or to the window of pixels srcwin = [xoff, yoff, xsize, ysize]
+    if use_gdal_bindings:
+        ds = gdal.Translate(fic_out, fic_in, format=output_format, projWin=projwin, srcWin=srcwin)
+        if ds is None:
+            raise RuntimeError(f'gdal.Translate failed to write {fic_out}')
+        ds = None
+    else:
+        cmd = [gdal_prefix + 'gdal_translate', '-of', output_format.upper()]
+        if projwin is not None:
+            cmd += ['-projwin'] + [str(v) for v in projwin]
+        if srcwin is not None:
+            cmd += ['-srcwin'] + [str(v) for v in srcwin]
+        run_gdal_tool(cmd + [fic_in, fic_out])
+
+
+def warp_tif(fic_in, fic_out, srs, bounds, res, gdal_prefix):
+    # Reproject fic_in to srs, on the grid of resolution res covering bounds = [xmin, ymin, xmax, ymax]
+    if use_gdal_bindings:
+        ds = gdal.Warp(fic_out, fic_in, format='GTiff', dstSRS=srs, outputBounds=bounds, xRes=res, yRes=res,
+                       resampleAlg='bilinear', dstNodata=-9999)
+        if ds is None:
+            raise RuntimeError(f'gdal.Warp failed to write {fic_out}')
+        ds = None
+    else:
+        run_gdal_tool([gdal_prefix + 'gdalwarp', '-overwrite', '-of', 'GTiff', '-dstnodata', '-9999', '-t_srs', srs,
+                       '-te'] + [str(v) for v in bounds] + ['-tr', str(res), str(res), '-r', 'bilinear',
+                                                           fic_in, fic_out])
+
+
+def srtm_tiles(srtm_dir, bounds):
+    # SRTM tiles (.hgt or .tif) of srtm_dir that intersect bounds = [lon_min, lat_min, lon_max, lat_max]
+    list_srtm = []
+    for entry in sorted(os.listdir(srtm_dir)):
+        if not entry.lower().endswith(('.hgt', '.tif', '.tiff')):
+            continue
+        fic = os.path.join(srtm_dir, entry)
+        ds = gdal.Open(fic)
+        gt = ds.GetGeoTransform()
+        xmin, ymax = gt[0], gt[3]
+        xmax, ymin = xmin + gt[1] * ds.RasterXSize, ymax + gt[5] * ds.RasterYSize
+        ds = None
+        if xmin < bounds[2] and xmax > bounds[0] and ymin < bounds[3] and ymax > bounds[1]:
+            list_srtm.append(fic)
+
+    return list_srtm
+
+
+def valid_data_window(fic, block_rows=512):
+    # Smallest window [xoff, yoff, xsize, ysize] of fic that contains all its valid data, i.e., the values > 0
+    # that are not nodata. None if there are no valid data.
+    # The raster is scanned by blocks of rows, so the memory used does not depend on its size
+    ds = gdal.Open(fic)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    ncols, nrows = ds.RasterXSize, ds.RasterYSize
+
+    valid_cols = np.zeros(ncols, dtype=bool)
+    row_min, row_max = None, None
+    for row in range(0, nrows, block_rows):
+        nrows_block = min(block_rows, nrows - row)
+        z = band.ReadAsArray(0, row, ncols, nrows_block)
+        valid = z > 0
+        if nodata is not None:
+            valid &= z != nodata
+
+        valid_rows = np.flatnonzero(valid.any(axis=1))
+        if valid_rows.size:
+            if row_min is None:
+                row_min = row + valid_rows[0]
+            row_max = row + valid_rows[-1]
+            valid_cols |= valid.any(axis=0)
+    ds = None
+
+    if row_min is None:
+        return None
+
+    cols = np.flatnonzero(valid_cols)
+    return [int(cols[0]), int(row_min), int(cols[-1] - cols[0] + 1), int(row_max - row_min + 1)]
+
+
+def clip_tif(fic_in, fic_out, xmin, xmax, ymin, ymax, gdal_prefix, output_format='GTiff'):
+    translate_tif(fic_in, fic_out, gdal_prefix, projwin=[xmin, ymax, xmax, ymin], output_format=output_format)
+
+
+# Precision of the variables when they are stored as scaled int16
+# U and V in m/s (up to +/- 327 m/s), speed up (up to 32)
+int16_scale = {'U': 0.01, 'V': 0.01, 'spd': 0.001}
+
+
+def build_cog(fic_cog, list_tif, gdal_prefix, compress='DEFLATE', scale=None):
+    # Mosaic the tiles in a single Cloud-Optimized GeoTIFF: tiled, compressed, with internal overviews.
+    # If scale is given, values are stored as int16 (value / scale) with the scale in the metadata
+    fic_vrt = fic_cog[:-4] + '_mosaic.vrt'
+    build_vrt(fic_vrt, list_tif, gdal_prefix)
+
+    options = []
+    if scale is not None:
+        options += ['-ot', 'Int16', '-scale', '0', str(scale), '0', '1', '-a_scale', str(scale), '-a_offset', '0',
+                    '-a_nodata', '-32768']
+        predictor = '2'
+    else:
+        predictor = '3'
+
+    creation = ['COMPRESS=' + compress]
+    if compress != 'NONE':
+        creation += ['PREDICTOR=' + predictor]
+
+    # The COG driver is available from GDAL 3.1
+    if gdal.GetDriverByName('COG') is not None:
+        options += ['-of', 'COG', '-co', 'OVERVIEWS=AUTO', '-co', 'RESAMPLING=AVERAGE', '-co', 'BLOCKSIZE=512']
+        options += [o for c in creation for o in ['-co', c]]
+        gdal_translate(fic_vrt, fic_cog, options, gdal_prefix)
+    else:
+        # Same layout with the GTiff driver: overviews are built on a tiled copy, then copied in front of the data
+        fic_tiled = fic_cog[:-4] + '_tiled.tif'
+        gdal_translate(fic_vrt, fic_tiled, options + ['-of', 'GTiff', '-co', 'TILED=YES'], gdal_prefix)
+
+        ds = gdal.Open(fic_tiled, gdal.GA_Update)
+        levels = []
+        size = max(ds.RasterXSize, ds.RasterYSize)
+        while size > 512:
+            size //= 2
+            levels.append(2 ** (len(levels) + 1))
+        if levels:
+            ds.BuildOverviews('AVERAGE', levels)
+        ds = None
+
+        options = ['-of', 'GTiff', '-co', 'TILED=YES', '-co', 'BLOCKXSIZE=512', '-co', 'BLOCKYSIZE=512',
+                   '-co', 'COPY_SRC_OVERVIEWS=YES']
+        options += [o for c in creation for o in ['-co', c]]
+        gdal_translate(fic_tiled, fic_cog, options, gdal_prefix)
+        os.remove(fic_tiled)
+
+    os.remove(fic_vrt)
+
+
+def gdal_translate(fic_in, fic_out, options, gdal_prefix):
+    # gdal_translate with a list of command line options
+    if use_gdal_bindings:
+        ds = gdal.Translate(fic_out, fic_in, options=options)
+        if ds is None:
+            raise RuntimeError(f'gdal.Translate failed to write {fic_out}')
+        ds = None
+    else:
+        run_gdal_tool([gdal_prefix + 'gdal_translate'] + options + [fic_in, fic_out])
+
+
+def build_vrt(fic_vrt, list_tif, gdal_prefix):
+    if use_gdal_bindings:
+        ds = gdal.BuildVRT(fic_vrt, list_tif)
+        if ds is None:
+            raise RuntimeError(f'gdal.BuildVRT failed to write {fic_vrt}')
+        ds = None
+    else:
+        fic_list = fic_vrt + '.txt'
+        with open(fic_list, 'w') as fic_file:
+            fic_file.write('\n'.join(list_tif) + '\n')
+        run_gdal_tool([gdal_prefix + 'gdalbuildvrt', '-input_file_list', fic_list, fic_vrt])
+        os.remove(fic_list)
+
+
+def save_tif(var, gt, proj, fic):
+    # Create the geotif. An existing file is removed first rather than overwritten in place, as it may be a hard link
+    # to the output of another library (see extend_from)
+    if os.path.exists(fic):
+        os.remove(fic)
+    driver = gdal.GetDriverByName('GTiff')
+    rows, cols = var.shape
     outDs = driver.Create(fic, cols, rows, 1, gdal.GDT_Float32)
+
+    # Georeference the image and set the projection
+    outDs.SetGeoTransform(gt)
+    outDs.SetProjection(proj)
+
     # Create new band
     outBand = outDs.GetRasterBand(1)
     outBand.WriteArray(var, 0, 0)
@@ -423,10 +3091,6 @@ def save_tif(var, inDs, fic):
     # Flush data to disk
     outBand.FlushCache()
 
-    # Georeference the image and set the projection
-    outDs.SetGeoTransform(inDs.GetGeoTransform())
-    outDs.SetProjection(inDs.GetProjection())
-
     outDs = None
 
 
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Wind Mapper
+# Downscaling of coarse wind fields (e.g., NWP outputs) with a finished wind library.
+# For each coarse time step, the coarse wind is interpolated to the cells of the library, the library is read for the
+# direction of the coarse wind (interpolated between the two nearest directions of the library, their wind vectors
+# rotated to the direction) and the coarse wind speed is multiplied by the speed up of the library.
+# The library is read from the memory-mapped copy of windmapper_query.py. The time series is processed by chunks of
+# time steps in parallel processes, each chunk by blocks of rows, so that the memory used does not depend on the
+# length of the time series nor on the size of the domain. The outputs are memory-mapped arrays of shape
+# (time, rows, cols) on the grid of the library.
+#
+#   windmapper_downscale.py /path/to/output forcing.nc --output winds --u u10 --v v10
+#
+# or from python:
+#
+#   ds = Downscaler('/path/to/output')
+#   winds = ds.downscale(u, v, x, y)   # dict of arrays (time, rows, cols): U, V and spd
+
+
+import argparse
+import json
+import os
+from concurrent import futures
+from functools import partial
+
+import numpy as np
+from tqdm import tqdm
+
+import windmapper
+from windmapper_query import WindLibrary
+
+# Outputs: wind components and speed (m/s)
+output_variables = ['U', 'V', 'spd']
+
+
+class Downscaler(object):
+    # Number of (time step, cell) pairs processed at once, to bound the memory used by the temporary arrays
+    chunk_cells = 2 ** 21
+
+    def __init__(self, user_output_dir, rebuild=False):
+        self.user_output_dir = user_output_dir
+        self.library = WindLibrary(user_output_dir, rebuild=rebuild)
+
+    def downscale(self, u, v, x, y):
+        # Downscale the coarse winds u, v of shape (time, y, x), given at the coarse cell centers x, y in the
+        # coordinate system of the library. Returns a dict with an array of shape (time, rows, cols) per output
+        nrows, ncols = self.library.data.shape[:2]
+        u = np.asarray(u, dtype=np.float32)
+        v = np.asarray(v, dtype=np.float32)
+        out = {var: np.empty((u.shape[0], nrows, ncols), dtype=np.float32) for var in output_variables}
+        for row0, row1 in self.row_blocks(u.shape[0]):
+            block = self.downscale_block(u, v, x, y, row0, row1)
+            for var in output_variables:
+                out[var][:, row0:row1] = block[var]
+        return out
+
+    def row_blocks(self, ntimes):
+        nrows, ncols = self.library.data.shape[:2]
+        block_rows = max(1, self.chunk_cells // (ntimes * ncols))
+        return [(row0, min(row0 + block_rows, nrows)) for row0 in range(0, nrows, block_rows)]
+
+    def downscale_block(self, u, v, x, y, row0, row1):
+        # Downscaled winds on the rows row0 to row1 of the library
+        lib = self.library
+        nrows, ncols, ndirs, nvars = lib.data.shape
+        gt = lib.gt
+
+        # Coarse winds, bilinear interpolation to the centers of the cells of the block
+        ix0, ix1, wx = coarse_weights(x, gt[0] + (np.arange(ncols) + 0.5) * gt[1])
+        iy0, iy1, wy = coarse_weights(y, gt[3] + (np.arange(row0, row1) + 0.5) * gt[5])
+
+        def interp(a):
+            a = a[:, iy0, :] * (1. - wy)[None, :, None] + a[:, iy1, :] * wy[None, :, None]
+            return a[:, :, ix0] * (1. - wx) + a[:, :, ix1] * wx
+
+        uc = interp(u)
+        vc = interp(v)
+        spd = np.hypot(uc, vc)
+        # Direction the wind comes from
+        wdir = np.mod(np.degrees(np.arctan2(-uc, -vc)), 360.)
+
+        # Two nearest directions of the library (equally spaced)
+        delta = 360. / ndirs
+        fd = wdir / delta
+        kd = np.floor(fd).astype(np.intp)
+        wd = (fd - kd).astype(np.float32)
+
+        # Library for the two directions, with its wind vectors rotated to the direction of the coarse wind
+        flat = lib.data.reshape(-1, nvars)
+        cell = ((np.arange(row0, row1)[:, None] * ncols + np.arange(ncols)[None, :]) * ndirs)[None, :, :]
+        uu = np.zeros(uc.shape, dtype=np.float32)
+        vv = np.zeros(uc.shape, dtype=np.float32)
+        speed_up = np.zeros(uc.shape, dtype=np.float32)
+        for k, w in [(kd, 1. - wd), (kd + 1, wd)]:
+            values = np.take(flat, cell + k % ndirs, axis=0)
+            rot = np.radians(wdir - k * delta).astype(np.float32)
+            cos, sin = np.cos(rot), np.sin(rot)
+            uu += w * (cos * values[..., 0] + sin * values[..., 1])
+            vv += w * (-sin * values[..., 0] + cos * values[..., 1])
+            speed_up += w * values[..., 2]
+
+        # Coarse wind speed times the speed up, in the direction of the library
+        speed = spd * speed_up
+        norm = np.hypot(uu, vv)
+        scale = np.divide(speed, norm, out=np.zeros_like(speed), where=norm > 0)
+        return {'U': uu * scale, 'V': vv * scale, 'spd': speed}
+
+    def run(self, fic_forcing, output, u_name='u', v_name='v', x_name='x', y_name='y', time_name='time',
+            time_chunk=24, nworkers=None):
+        # Downscale the coarse winds u_name and v_name (time, y, x) of the NetCDF file fic_forcing, by chunks of
+        # time_chunk time steps in nworkers processes (default: all the cores). The outputs are written to
+        # <output>_<var>.npy, with the grid and the times in <output>.json. Returns the paths of the outputs
+        try:
+            import netCDF4
+        except ImportError:
+            raise windmapper.WindMapperError('ERROR: reading the forcing requires the netCDF4 package '
+                                             '(pip install netCDF4)')
+
+        with netCDF4.Dataset(fic_forcing) as nc:
+            ntimes = nc.variables[u_name].shape[0]
+            meta = {'geotransform': self.library.gt, 'projection': self.library.projection, 'forcing': fic_forcing}
+            if time_name in nc.variables:
+                meta['time'] = nc.variables[time_name][:].tolist()
+                meta['time_units'] = getattr(nc.variables[time_name], 'units', None)
+
+        nrows, ncols = self.library.data.shape[:2]
+        outputs = {var: output + '_' + var + '.npy' for var in output_variables}
+        for fic in outputs.values():
+            data = np.lib.format.open_memmap(fic, mode='w+', dtype=np.float32, shape=(ntimes, nrows, ncols))
+            del data
+
+        chunks = [(t0, min(t0 + time_chunk, ntimes)) for t0 in range(0, ntimes, time_chunk)]
+        run_chunk = partial(downscale_chunk, self.user_output_dir, fic_forcing, [u_name, v_name, x_name, y_name],
+                            outputs, self.chunk_cells)
+        with futures.ProcessPoolExecutor(max_workers=nworkers) as executor:
+            for _ in tqdm(executor.map(run_chunk, chunks), total=len(chunks)):
+                pass
+
+        with open(output + '.json', 'w') as fic_file:
+            json.dump(meta, fic_file)
+
+        return outputs
+
+
+def coarse_weights(coords, points):
+    # Indices of the two coarse cells bounding each point and weight of the second one, for coarse cell centers
+    # coords in increasing or decreasing order. Points outside of the coarse grid get the nearest coarse cell
+    order = np.argsort(coords)
+    f = np.interp(points, np.asarray(coords)[order], np.arange(len(order)))
+    k0 = np.minimum(np.floor(f).astype(np.intp), max(len(order) - 2, 0))
+    k1 = np.minimum(k0 + 1, len(order) - 1)
+    w = (f - k0).astype(np.float32)
+    return order[k0], order[k1], w
+
+
+def downscale_chunk(user_output_dir, fic_forcing, names, outputs, chunk_cells, chunk):
+    # Downscale the time steps t0 to t1 of the forcing into the memory-mapped outputs. Run in a worker process
+    import netCDF4
+
+    t0, t1 = chunk
+    u_name, v_name, x_name, y_name = names
+    with netCDF4.Dataset(fic_forcing) as nc:
+        u = np.ma.filled(nc.variables[u_name][t0:t1], np.nan).astype(np.float32)
+        v = np.ma.filled(nc.variables[v_name][t0:t1], np.nan).astype(np.float32)
+        x = np.asarray(nc.variables[x_name][:], dtype=np.float64)
+        y = np.asarray(nc.variables[y_name][:], dtype=np.float64)
+
+    downscaler = Downscaler(user_output_dir)
+    downscaler.chunk_cells = chunk_cells
+    out = {var: np.load(fic, mmap_mode='r+') for var, fic in outputs.items()}
+    for row0, row1 in downscaler.row_blocks(t1 - t0):
+        block = downscaler.downscale_block(u, v, x, y, row0, row1)
+        for var in output_variables:
+            out[var][t0:t1, row0:row1] = block[var]
+    for data in out.values():
+        data.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Downscale coarse wind fields with a finished Windmapper library.')
+    parser.add_argument('library', help='output directory of the Windmapper run (user_output_dir)')
+    parser.add_argument('forcing', help='NetCDF file of the coarse winds, with variables of dimensions (time, y, x) '
+                                        'on a grid in the coordinate system of the library')
+    parser.add_argument('--output', required=True,
+                        help='prefix of the outputs: <output>_U.npy, <output>_V.npy, <output>_spd.npy and <output>.json')
+    parser.add_argument('--u', default='u', help='name of the U variable of the forcing (default: u)')
+    parser.add_argument('--v', default='v', help='name of the V variable of the forcing (default: v)')
+    parser.add_argument('--x', default='x', help='name of the x coordinate of the forcing (default: x)')
+    parser.add_argument('--y', default='y', help='name of the y coordinate of the forcing (default: y)')
+    parser.add_argument('--time', default='time', help='name of the time variable of the forcing (default: time)')
+    parser.add_argument('--time-chunk', type=int, default=24, help='number of time steps processed at once')
+    parser.add_argument('--nworkers', type=int, help='number of processes (default: all the cores)')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the memory-mapped copy of the library')
+    args = parser.parse_args()
+
+    try:
+        downscaler = Downscaler(args.library, rebuild=args.rebuild)
+        outputs = downscaler.run(args.forcing, os.path.abspath(args.output), args.u, args.v, args.x, args.y,
+                                 args.time, args.time_chunk, args.nworkers)
+    except windmapper.WindMapperError as e:
+        print(e)
+        exit(-1)
+
+    print('Outputs written to ' + ', '.join(outputs.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Wind Mapper
+# Point queries over a finished wind library.
+# The library (one VRT or COG per direction and variable) is converted once to a single memory-mapped array of
+# shape (rows, cols, directions, variables) in user_output_dir/query, so that all the values needed by a point are
+# close to each other on disk. Queries are answered with numpy: bilinear interpolation in space and linear
+# interpolation between the two nearest directions of the library, their wind vectors rotated to the direction.
+#
+#   windmapper_query.py /path/to/output --points nodes.csv --direction 270 --output winds.csv
+#
+# or from python:
+#
+#   lib = WindLibrary('/path/to/output')
+#   winds = lib.query(x, y, 270.)   # dict of arrays, one per variable (U, V, spd_up_*)
+
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal
+
+import windmapper
+
+gdal.UseExceptions()  # Enable exception support
+
+
+class WindLibrary(object):
+    # Points are processed by chunks, to bound the memory used by the temporary arrays
+    chunk_size = 1000000
+
+    def __init__(self, user_output_dir, rebuild=False):
+        user_output_dir = os.path.abspath(user_output_dir) + os.path.sep
+        self.manifest = windmapper.load_manifest(user_output_dir + 'jobs.json')
+        cfg = self.manifest['config']
+
+        self.query_dir = user_output_dir + 'query' + os.path.sep
+        fic_meta = self.query_dir + 'library.json'
+        fic_data = self.query_dir + 'library.npy'
+
+        self.directions = np.arange(0, 360., 360. / cfg['ncat'])
+        self.variables = list(cfg['list_tif_2_vrt'])
+        files = [windmapper.library_file(cfg, wdir, var) for wdir in self.directions for var in self.variables]
+        missing = [fic for fic in files if not os.path.exists(fic)]
+        if missing:
+            raise windmapper.WindMapperError(f'ERROR: the library is not complete, {missing[0]} is missing')
+
+        # The memory-mapped copy is rebuilt if the library changed since it was made
+        if rebuild or not os.path.exists(fic_meta) or \
+                os.path.getmtime(fic_meta) < max(os.path.getmtime(fic) for fic in files):
+            self.build(cfg, fic_data, fic_meta)
+
+        with open(fic_meta) as fic_file:
+            meta = json.load(fic_file)
+        self.gt = meta['geotransform']
+        self.projection = meta['projection']
+        self.data = np.load(fic_data, mmap_mode='r')
+
+    def build(self, cfg, fic_data, fic_meta, block_rows=256):
+        # Copy the library, by blocks of rows, to a single array of shape (rows, cols, directions, variables)
+        os.makedirs(self.query_dir, exist_ok=True)
+
+        ds = gdal.Open(windmapper.library_file(cfg, self.directions[0], self.variables[0]))
+        ncols, nrows = ds.RasterXSize, ds.RasterYSize
+        meta = {'geotransform': ds.GetGeoTransform(), 'projection': ds.GetProjection(),
+                'directions': self.directions.tolist(), 'variables': self.variables}
+        ds = None
+
+        data = np.lib.format.open_memmap(fic_data + '.tmp', mode='w+', dtype=np.float32,
+                                         shape=(nrows, ncols, len(self.directions), len(self.variables)))
+        for k, wdir in enumerate(self.directions):
+            for n, var in enumerate(self.variables):
+                ds = gdal.Open(windmapper.library_file(cfg, wdir, var))
+                band = ds.GetRasterBand(1)
+                nodata = band.GetNoDataValue()
+                scale = band.GetScale()
+                for row in range(0, nrows, block_rows):
+                    nrows_block = min(block_rows, nrows - row)
+                    values = band.ReadAsArray(0, row, ncols, nrows_block).astype(np.float32)
+                    if nodata is not None:
+                        values[values == nodata] = np.nan
+                    # COGs stored as scaled int16
+                    if scale not in [None, 1.]:
+                        values *= scale
+                    data[row:row + nrows_block, :, k, n] = values
+                ds = None
+        data.flush()
+        del data
+        os.replace(fic_data + '.tmp', fic_data)
+
+        with open(fic_meta, 'w') as fic_file:
+            json.dump(meta, fic_file)
+
+    def query(self, x, y, wdir):
+        # Wind at points (x, y), in the coordinate system of the library, for the direction(s) wdir (in degrees, the
+        # direction the wind comes from). Returns a dict with an array per variable, NaN outside of the library
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        wdir = np.broadcast_to(np.asarray(wdir, dtype=np.float64), x.shape)
+
+        out = np.empty((x.size, len(self.variables)), dtype=np.float32)
+        for start in range(0, x.size, self.chunk_size):
+            end = min(start + self.chunk_size, x.size)
+            out[start:end] = self.query_chunk(x[start:end], y[start:end], wdir[start:end])
+
+        return {var: out[:, n] for n, var in enumerate(self.variables)}
+
+    def query_chunk(self, x, y, wdir):
+        nrows, ncols, ndirs, _ = self.data.shape
+        gt = self.gt
+
+        # Position in the grid of the cell centers
+        fx = (x - gt[0]) / gt[1] - 0.5
+        fy = (y - gt[3]) / gt[5] - 0.5
+        outside = (fx < -0.5) | (fx > ncols - 0.5) | (fy < -0.5) | (fy > nrows - 0.5)
+        fx = np.clip(fx, 0., ncols - 1.)
+        fy = np.clip(fy, 0., nrows - 1.)
+        ix = np.minimum(fx.astype(np.intp), max(ncols - 2, 0))
+        iy = np.minimum(fy.astype(np.intp), max(nrows - 2, 0))
+        ix1 = np.minimum(ix + 1, ncols - 1)
+        iy1 = np.minimum(iy + 1, nrows - 1)
+        wx = (fx - ix)[:, None].astype(np.float32)
+        wy = (fy - iy)[:, None].astype(np.float32)
+
+        # Two nearest directions of the library (equally spaced)
+        delta = 360. / ndirs
+        wdir = np.mod(wdir, 360.)
+        fd = wdir / delta
+        kd = np.floor(fd).astype(np.intp)
+        wd = (fd - kd)[:, None].astype(np.float32)
+
+        # The 8 neighbours are gathered from the array seen as (rows x cols x directions, variables). The wind
+        # vectors of each direction are rotated to wdir before the interpolation between the directions, as in
+        # fill_directions: only the speed up is interpolated linearly
+        flat = self.data.reshape(-1, self.data.shape[3])
+        out = np.zeros((x.size, self.data.shape[3]), dtype=np.float32)
+        for k, w_dir in [(kd, 1. - wd), (kd + 1, wd)]:
+            values = np.zeros((x.size, self.data.shape[3]), dtype=np.float32)
+            for r, w_row in [(iy, 1. - wy), (iy1, wy)]:
+                for c, w_col in [(ix, 1. - wx), (ix1, wx)]:
+                    cell = (r * ncols + c) * ndirs
+                    values += np.take(flat, cell + k % ndirs, axis=0) * (w_row * w_col)
+
+            rot = np.radians(wdir - k * delta).astype(np.float32)
+            cos, sin = np.cos(rot), np.sin(rot)
+            u, v = values[:, 0].copy(), values[:, 1].copy()
+            values[:, 0] = cos * u + sin * v
+            values[:, 1] = -sin * u + cos * v
+            out += values * w_dir
+
+        out[outside] = np.nan
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wind at a set of points from a finished Windmapper library.')
+    parser.add_argument('library', help='output directory of the Windmapper run (user_output_dir)')
+    parser.add_argument('--points', help='csv file of the points: x,y or x,y,direction, in the coordinate system '
+                                         'of the library. A header line is allowed')
+    parser.add_argument('--direction', type=float,
+                        help='direction the wind comes from (in degrees), if not given for each point')
+    parser.add_argument('--output', help='csv file of the results (default: standard output)')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the memory-mapped copy of the library')
+    args = parser.parse_args()
+
+    try:
+        lib = WindLibrary(args.library, rebuild=args.rebuild)
+    except windmapper.WindMapperError as e:
+        print(e)
+        exit(-1)
+
+    if args.points is None:
+        print(f'Memory-mapped library ready in {lib.query_dir}')
+        return
+
+    with open(args.points) as fic_file:
+        header = fic_file.readline()
+    skip = 0 if all(is_number(v) for v in header.split(',')) else 1
+    points = np.loadtxt(args.points, delimiter=',', skiprows=skip, ndmin=2)
+
+    if points.shape[1] >= 3:
+        wdir = points[:, 2]
+    elif args.direction is not None:
+        wdir = args.direction
+    else:
+        print('ERROR: the direction must be given with --direction or as the third column of the points')
+        exit(-1)
+
+    winds = lib.query(points[:, 0], points[:, 1], wdir)
+    result = np.column_stack([points[:, 0], points[:, 1], np.broadcast_to(wdir, points[:, 0].shape)] +
+                             [winds[var] for var in lib.variables])
+    np.savetxt(args.output if args.output is not None else sys.stdout, result, delimiter=',', fmt='%.6g',
+               header=','.join(['x', 'y', 'direction'] + lib.variables), comments='')
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+if __name__ == "__main__":
+    main()